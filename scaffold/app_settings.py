@@ -49,6 +49,73 @@ PATH_CACHE_TTL = _get_setting('PATH_CACHE_TTL',
 PATH_CACHE_KEY = _get_setting('PATH_CACHE_KEY',
     default="scaffold-path-map" 
 )
+LOCAL_PATH_CACHE = _get_setting('LOCAL_PATH_CACHE',
+    default=True
+)
+PATH_CACHE_SOFT_TTL = _get_setting('PATH_CACHE_SOFT_TTL',
+    default=None
+)
+PATH_CACHE_LOCK_TIMEOUT = _get_setting('PATH_CACHE_LOCK_TIMEOUT',
+    default=30
+)
+PATH_CACHE_LOCK_WAIT = _get_setting('PATH_CACHE_LOCK_WAIT',
+    default=3
+)
+
+CACHE_SECTION_RECORDS = _get_setting('CACHE_SECTION_RECORDS',
+    default=False
+)
+
+DEFER_PATH_MAP_UPDATES = _get_setting('DEFER_PATH_MAP_UPDATES',
+    default=False
+)
+
+NEGATIVE_PATH_CACHE_SIZE = _get_setting('NEGATIVE_PATH_CACHE_SIZE',
+    default=1000
+)
+NEGATIVE_PATH_CACHE_TTL = _get_setting('NEGATIVE_PATH_CACHE_TTL',
+    default=300
+)
+
+INHERITED_FIELDS_CACHE_TTL = _get_setting('INHERITED_FIELDS_CACHE_TTL',
+    default=0
+)
+
+LATEST_CONTENT_CACHE_TTL = _get_setting('LATEST_CONTENT_CACHE_TTL',
+    default=0
+)
+
+PARALLEL_CONTENT_QUERIES = _get_setting('PARALLEL_CONTENT_QUERIES',
+    default=0
+)
+
+RESOLVE_NEAREST_SECTION = _get_setting('RESOLVE_NEAREST_SECTION',
+    default=False
+)
+
+MIDDLEWARE_INCLUDE_PREFIXES = _get_setting('MIDDLEWARE_INCLUDE_PREFIXES',
+    default=None
+)
+
+MIDDLEWARE_EXCLUDE_PREFIXES = _get_setting('MIDDLEWARE_EXCLUDE_PREFIXES',
+    default=()
+)
+
+NAVIGATION_CACHE_TTL = _get_setting('NAVIGATION_CACHE_TTL',
+    default=(60 * 60 * 12)
+)
+
+USE_SECTION_TREE = _get_setting('USE_SECTION_TREE',
+    default=False
+)
+
+SECTION_TREE_STORAGE = _get_setting('SECTION_TREE_STORAGE',
+    default=None
+)
+
+SECTION_TREE_DIR = _get_setting('SECTION_TREE_DIR',
+    default=None
+)
 
 ALLOW_ASSOCIATED_ORDERING = _get_setting('ALLOW_ASSOCIATED_ORDERING',   
     default=True
@@ -0,0 +1,492 @@
+"""
+Helpers used to query the content associated with sections.
+"""
+import datetime
+import heapq
+from Queue import Empty, Queue
+import sys
+import threading
+
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.contenttypes import generic
+from django.db import connections, models, transaction
+from django.db.models import Count
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.encoding import force_unicode
+
+def _get_label(model):
+    """
+    Returns the '{app name}.{model name}' label of the given model (or model
+    instance), as used by the only argument of get_associated_content.
+    """
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+def _get_content_type_ids(labels):
+    """
+    Returns the ids of the content types of the models with the given
+    '{app name}.{model name}' labels. Labels of unknown models are ignored.
+    """
+    content_type_ids = []
+    for label in labels:
+        try:
+            app_label, object_name = label.split(".")
+        except ValueError:
+            continue
+        model = models.get_model(app_label, object_name)
+        if model is not None and model._meta.object_name == object_name:
+            content_type_ids.append(
+                ContentType.objects.get_for_model(model).pk
+            )
+    return content_type_ids
+
+def _get_generic_foreign_key(model):
+    """
+    Returns the generic foreign key of the given model (preferring one named
+    ``content_object``, as on SectionItem), or None if it doesn't have one.
+    """
+    generic_fks = [f for f in model._meta.virtual_fields
+        if isinstance(f, generic.GenericForeignKey)]
+    for generic_fk in generic_fks:
+        if generic_fk.name == 'content_object':
+            return generic_fk
+    return generic_fks and generic_fks[0] or None
+
+class ContentItem(object):
+    """
+    An immutable row describing a piece of content associated with a section.
+    It unpacks (and indexes) like the tuples these methods always returned::
+
+        obj, app, model, relationship_type = item
+
+    ...and also carries the sort key the row was sorted on, if any. Rows
+    never modify the objects they hold, so both can be cached and shared.
+    """
+    __slots__ = ('object', 'app', 'model', 'relationship_type', 'sort_key')
+
+    def __init__(self, obj, relationship_type, sort_key=None):
+        set_slot = super(ContentItem, self).__setattr__
+        set_slot('object', obj)
+        set_slot('app', obj._meta.app_label)
+        set_slot('model', obj._meta.object_name)
+        set_slot('relationship_type', relationship_type)
+        set_slot('sort_key', sort_key)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ContentItem objects are immutable.")
+
+    def __delattr__(self, name):
+        raise AttributeError("ContentItem objects are immutable.")
+
+    def __iter__(self):
+        return iter(self._as_tuple())
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, index):
+        return self._as_tuple()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, ContentItem):
+            other = other._as_tuple()
+        return self._as_tuple() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._as_tuple())
+
+    def __repr__(self):
+        return "<ContentItem: %s.%s %r (%s)>" % (
+            self.app, self.model, self.object, self.relationship_type
+        )
+
+    def __reduce__(self):
+        # Rows are immutable, so they can't be unpickled attribute by
+        # attribute (e.g. when they're read from the cache).
+        return (ContentItem, (self.object, self.relationship_type,
+            self.sort_key))
+
+    def _as_tuple(self):
+        return (self.object, self.app, self.model, self.relationship_type)
+
+    @property
+    def content_type(self):
+        """The '{app name}.{model name}' label of the object."""
+        return "%s.%s" % (self.app, self.model)
+
+class ContentRelation(object):
+    """
+    A relation through which content is attached to a section, classified
+    once so that querying a section's content doesn't have to reflect on its
+    model every time:
+
+    * ``accessor_name``: the name of the related manager on the section.
+    * ``field_name``: the name of the foreign key to the section on the
+      related model.
+    * ``label``: the '{app name}.{model name}' label of the related model.
+    * ``generic_fk``: the generic foreign key of the related model, if it
+      attaches content generically (as SectionItem does), else None.
+    * ``ordering``: the default ordering of the related model.
+    * ``get_latest_by``: the ``get_latest_by`` field of the related model,
+      or None.
+    """
+
+    def __init__(self, related):
+        self.related = related
+        self.model = related.model
+        self.accessor_name = related.get_accessor_name()
+        self.field_name = related.field.name
+        self.label = _get_label(related.model)
+        self.generic_fk = _get_generic_foreign_key(related.model)
+        self.ordering = list(related.model._meta.ordering)
+        self.get_latest_by = related.model._meta.get_latest_by or None
+
+    def __repr__(self):
+        return "<ContentRelation: %s>" % self.accessor_name
+
+    @property
+    def is_generic(self):
+        return self.generic_fk is not None
+
+    @property
+    def relationship_type(self):
+        return self.is_generic and 'generic-foreign-key' or 'foreign-key'
+
+    def is_wanted(self, only, content_type_ids):
+        """
+        Returns whether the relation may hold content of the types listed in
+        ``only`` (with ``content_type_ids`` being their content type ids). An
+        empty ``only`` list means any type is wanted.
+        """
+        if len(only) == 0:
+            return True
+        if self.is_generic:
+            return len(content_type_ids) != 0
+        return self.label in only
+
+    def get_items(self, section, content_type_ids=[]):
+        """
+        Returns a queryset of the given section's items in this relation, or
+        None if the section has none. Generic items are restricted to the
+        given content type ids, if any.
+        """
+        try:
+            fk_items = getattr(section, self.accessor_name)
+        except section.DoesNotExist:
+            return None
+        return self._filter_content_types(fk_items.all(), content_type_ids)
+
+    def get_subtree_items(self, section, content_type_ids=[],
+        include_self=True):
+        """
+        Returns a queryset of the items in this relation for the given
+        section and all its descendants (see BaseSection.filter_subtree).
+        Generic items are restricted to the given content type ids, if any.
+        """
+        fk_items = section.filter_subtree(
+            self.model._base_manager.all(), self.field_name, include_self
+        )
+        return self._filter_content_types(fk_items, content_type_ids)
+
+    def _filter_content_types(self, fk_items, content_type_ids):
+        if self.is_generic and len(content_type_ids) != 0:
+            fk_items = fk_items.filter(**{
+                '%s__in' % self.generic_fk.ct_field: content_type_ids
+            })
+        return fk_items
+
+    def count_items(self, section_pks, content_type_ids=[]):
+        """
+        Counts the items in this relation for each of the given sections with
+        a single (grouped) query. Returns a list of ``(section pk, label,
+        count)`` tuples, where generic items are counted per content type.
+        Generic items are restricted to the given content type ids, if any.
+        """
+        items = self.model._base_manager.filter(**{
+            '%s__in' % self.field_name: section_pks
+        })
+        if not self.is_generic:
+            return [
+                (row[self.field_name], self.label, row['count'])
+                for row in items.order_by().values(
+                    self.field_name
+                ).annotate(count=Count('pk'))
+            ]
+        ct_field = self.generic_fk.ct_field
+        if len(content_type_ids) != 0:
+            items = items.filter(**{'%s__in' % ct_field: content_type_ids})
+        counts = []
+        for row in items.order_by().values(
+            self.field_name, ct_field).annotate(count=Count('pk')):
+            model = ContentType.objects.get_for_id(row[ct_field]).model_class()
+            if model is not None:
+                counts.append(
+                    (row[self.field_name], _get_label(model), row['count'])
+                )
+        return counts
+
+# Content relations by section model, classified on first use: the related
+# objects of a model are only complete once every model has been loaded.
+_content_relations = {}
+
+def get_content_relations(model):
+    """
+    Returns the ContentRelation objects for all relations pointing at the
+    given section model (or section), in the order Django lists them.
+    """
+    if not isinstance(model, type):
+        model = model.__class__
+    relations = _content_relations.get(model)
+    if relations is None:
+        relations = [
+            ContentRelation(related)
+            for related in model._meta.get_all_related_objects()
+        ]
+        _content_relations[model] = relations
+    return relations
+
+def _can_query_in_parallel(using):
+    """
+    Returns whether queries on the given database can be run from other
+    threads. Each thread uses a connection of its own, so this isn't the case
+    for SQLite (an in-memory database isn't shared between connections) or
+    while the current thread has uncommitted changes, which other
+    connections can't see.
+    """
+    return connections[using].vendor != 'sqlite' and \
+        not transaction.is_dirty(using)
+
+def run_in_parallel(functions, max_workers, using=None):
+    """
+    Calls the given functions (which take no arguments) using a pool of at
+    most ``max_workers`` threads, and returns their results in the same
+    order. If any of them raises an exception, the first one is re-raised
+    once all have finished. Database connections opened by the worker
+    threads are closed before they exit.
+
+    The functions are simply called one after another if parallel queries
+    aren't possible on the given database alias, or there's nothing to gain.
+    """
+    functions = list(functions)
+    if max_workers <= 1 or len(functions) <= 1 or \
+        not _can_query_in_parallel(using or 'default'):
+        return [function() for function in functions]
+    results = [None] * len(functions)
+    errors = []
+    jobs = Queue()
+    for job in enumerate(functions):
+        jobs.put(job)
+
+    def work():
+        try:
+            while True:
+                try:
+                    index, function = jobs.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[index] = function()
+                except Exception:
+                    errors.append((index, sys.exc_info()))
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    workers = [
+        threading.Thread(target=work)
+        for i in range(min(max_workers, len(functions)))
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        exc_type, exc_value, exc_traceback = min(errors)[1]
+        raise exc_type, exc_value, exc_traceback
+    return results
+
+def _get_generic_objects(fk_items, generic_fk):
+    """
+    Returns the objects the items in the given manager or queryset point to
+    through the given generic foreign key, in the order of the items. Rather
+    than reading the generic foreign key of each item, which costs a query
+    per item, the objects are fetched with one query per content type.
+    Items pointing to objects which no longer exist are skipped.
+    """
+    pointers = [
+        (content_type_id, force_unicode(object_id))
+        for content_type_id, object_id in fk_items.values_list(
+            generic_fk.ct_field, generic_fk.fk_field
+        )
+    ]
+    object_ids = {}
+    for content_type_id, object_id in pointers:
+        object_ids.setdefault(content_type_id, set()).add(object_id)
+    objects = {}
+    for content_type_id, ids in object_ids.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            continue
+        for obj in model._base_manager.filter(pk__in=list(ids)):
+            objects[(content_type_id, force_unicode(obj.pk))] = obj
+    return [objects[pointer] for pointer in pointers if pointer in objects]
+
+def _get_generic_querysets(fk_items, generic_fk):
+    """
+    Returns a queryset per content type for the objects the items in the
+    given manager or queryset point to through the given generic foreign key.
+    The ids of the objects are selected with a subquery, so only the content
+    types themselves are queried here.
+    """
+    querysets = []
+    content_type_ids = fk_items.order_by().values_list(
+        generic_fk.ct_field, flat=True
+    ).distinct()
+    for content_type_id in content_type_ids:
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            continue
+        object_ids = fk_items.filter(**{
+            generic_fk.ct_field: content_type_id
+        }).values(generic_fk.fk_field)
+        querysets.append(model._base_manager.filter(pk__in=object_ids))
+    return querysets
+
+def _has_field(model, field_name):
+    try:
+        model._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
+def _get_sort_value(obj, sort_fields):
+    """
+    Returns the value of the first of the given fields present on the object,
+    or None if it has none of them.
+    """
+    for sort_field in sort_fields:
+        if hasattr(obj, sort_field):
+            return getattr(obj, sort_field)
+    return None
+
+class _Descending(object):
+    """Wraps a sort key so that it sorts in reverse order."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __cmp__(self, other):
+        return cmp(other.value, self.value)
+
+def _iter_queryset(queryset, chunk_size):
+    """
+    Iterates over the given (ordered) queryset, fetching ``chunk_size`` rows
+    at a time, so that only as many rows are read as are consumed.
+    """
+    start = 0
+    while True:
+        chunk = list(queryset[start:start + chunk_size])
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            return
+        start += chunk_size
+
+def _iter_stream(index, queryset, relationship_type, sort_key, chunk_size):
+    """
+    Yields ``(sort key, stream index, position, ContentItem)`` tuples for
+    the objects in the given queryset, sorted in SQL on the given sort key
+    (a field name, optionally prefixed by '-' for descending order). Objects
+    without the sort field, or with a NULL value for it, sort after all
+    others, in primary key order. The stream index and position keep the
+    merge stable.
+    """
+    field_name = sort_key.lstrip('-')
+    if _has_field(queryset.model, field_name):
+        if sort_key.startswith('-'):
+            sorted_queryset = queryset.order_by(sort_key, '-pk')
+        else:
+            sorted_queryset = queryset.order_by(sort_key, 'pk')
+        querysets = [(sorted_queryset, False)]
+        if queryset.model._meta.get_field(field_name).null:
+            # Databases disagree on where NULLs sort (and Python sorts None
+            # before anything else), so rows without a value are read
+            # separately, once all the others have been.
+            querysets = [
+                (sorted_queryset.filter(
+                    **{field_name + '__isnull': False}
+                ), False),
+                (queryset.filter(
+                    **{field_name + '__isnull': True}
+                ).order_by('pk'), True)
+            ]
+    else:
+        querysets = [(queryset.order_by('pk'), True)]
+    position = 0
+    for queryset, missing in querysets:
+        for obj in _iter_queryset(queryset, chunk_size):
+            value = None
+            if not missing:
+                value = getattr(obj, field_name)
+            item = ContentItem(obj, relationship_type, value)
+            # Dates and datetimes don't compare with each other, so that
+            # streams sorted on either can still be merged.
+            if type(value) is datetime.date:
+                value = datetime.datetime.combine(value, datetime.time())
+            if sort_key.startswith('-') and not missing:
+                value = _Descending(value)
+            yield ((missing, value), index, position, item)
+            position += 1
+
+def merge_content_streams(streams, sort_key, offset=0, limit=None,
+    chunk_size=100):
+    """
+    Merges the given ``(queryset, relationship type)`` streams into a single
+    iterator of ContentItem rows, sorted on the given sort key. A stream may
+    also be a ``(queryset, relationship type, sort key)`` tuple, to sort it
+    on a field of its own (e.g. the ``get_latest_by`` field of its model);
+    all sort keys should then sort in the same direction.
+
+    Each queryset is sorted in the database and read lazily, ``chunk_size``
+    rows at a time (or all rows needed for the requested page at once, if a
+    limit is given), so a page of content costs at most a query or two per
+    relation, however much content there is.
+
+    An object which appears in more than one stream is only returned once.
+    Objects with a NULL sort value come last, whichever way content is
+    sorted (and whichever way the database sorts NULLs). Since the streams
+    are merged in Python, the sort field should compare the same way in
+    Python as it does in the database (numbers and dates do; strings only
+    do under a binary collation).
+    """
+    if limit is not None:
+        chunk_size = offset + limit
+        if limit <= 0:
+            return
+    iterators = []
+    for index, stream in enumerate(streams):
+        queryset, relationship_type = stream[:2]
+        iterators.append(_iter_stream(
+            index,
+            queryset,
+            relationship_type,
+            len(stream) > 2 and stream[2] or sort_key,
+            chunk_size
+        ))
+    seen = set()
+    position = 0
+    merged = heapq.merge(*iterators)
+    for key, index, stream_position, item in merged:
+        object_id = (item.app, item.model, item.object.pk)
+        if object_id in seen:
+            continue
+        seen.add(object_id)
+        position += 1
+        if position <= offset:
+            continue
+        yield item
+        if limit is not None and position >= offset + limit:
+            return
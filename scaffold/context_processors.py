@@ -0,0 +1,9 @@
+from middleware import get_current_section
+
+def current_section(request):
+    """
+    Adds a ``current_section`` variable to the template context. Django's
+    template engine calls callable variables when they are used, so the
+    section is only looked up if a template actually uses the variable.
+    """
+    return {'current_section': lambda: get_current_section(request)}
@@ -1,88 +1,272 @@
+from __future__ import with_statement
+
+from contextlib import contextmanager
+import time
+
 from django.core.cache import cache
 from django.core.exceptions import MiddlewareNotUsed
-from django.db.models.signals import post_save, post_delete
+from django.core.signals import request_finished
+from django.db import router, transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, \
+    post_delete
 
 import app_settings
+from paths import SectionPathIndex, PathMissCache, LazySection, \
+    get_section_record, split_path
+from signals import section_moved
+from versions import get_tree_version, bump_tree_version
 
 
 # Import and work-around for python < 2.4
 try:
-    from threading import local
+    from threading import local, Lock
 except ImportError:
     from django.utils._threading_local import local
+    from dummy_threading import Lock
 _thread_locals = local()
+_pending_changes = local()
 
-def _build_section_path_map():
+# The process-local copy of the path map: a (tree version, index, next check)
+# tuple, where the last item is the time after which the index should be
+# fetched again even if the version hasn't changed. It is only ever replaced
+# as a whole, never modified. No version matches the placeholder until a copy
+# has been fetched.
+_NO_PATH_MAP = object()
+_local_path_map = (_NO_PATH_MAP, None, None)
+_local_path_map_lock = Lock()
+
+# Paths (in this process) which are known not to belong to any section.
+_path_misses = PathMissCache(
+    app_settings.NEGATIVE_PATH_CACHE_SIZE,
+    app_settings.NEGATIVE_PATH_CACHE_TTL
+)
+
+def _get_section_record_key(pk):
+    return "%s-section-%s" % (app_settings.PATH_CACHE_KEY, pk)
+
+def _build_section_path_map(version=None):
     """
     Simple wrapper around Django's low level cache; stores and populates 
-    a list of all section urls using the low-level caching framework.
+    an index of all section urls using the low-level caching framework.
+    The index maps full paths to primary keys. If ``CACHE_SECTION_RECORDS``
+    is set, a compact record of each section is cached as well.
+
+    Building the index doesn't bump the tree version; callers which rebuild
+    it because the tree changed have to. If the tree version the index is
+    built under is given, the index is dropped again should the tree change
+    while it's being built, since it may have missed that change.
     """
-    paths = {}
+    paths = SectionPathIndex()
+    paths.built_at = time.time()
+    records = {}
     Section = app_settings.get_extending_model()
-    for section in Section.objects.all():
-        paths[section.full_path] = section.slug
+    for record in Section.get_path_records():
+        pk, full_path = record[0], record[3]
+        paths[full_path] = pk
+        if app_settings.CACHE_SECTION_RECORDS:
+            records[_get_section_record_key(pk)] = record
     cache.set(app_settings.PATH_CACHE_KEY, paths, app_settings.PATH_CACHE_TTL) 
+    if version is not None and get_tree_version() != version:
+        cache.delete(app_settings.PATH_CACHE_KEY)
+        return paths
+    if records:
+        cache.set_many(records, app_settings.PATH_CACHE_TTL)
     return paths
 
-def _get_section_path_map():
+def _get_path_map_lock_key():
+    return "%s-lock" % app_settings.PATH_CACHE_KEY
+
+def _rebuild_section_path_map(wait=True):
     """
-    Simple wrapper around Django's low level cache; retrieves (and, if 
-    necessary, first populates) a list of all section urls using.
+    Rebuilds the path map, making sure only one process does so at a time.
+    The rebuild happens under a lock kept in the cache. If another process
+    holds the lock and `wait` is True, waits (for up to
+    ``PATH_CACHE_LOCK_WAIT`` seconds) for that process to store the map, and
+    returns it; if the wait times out, the map is built regardless. If
+    `wait` is False, returns None instead of waiting.
+    """
+    version = get_tree_version()
+    lock_key = _get_path_map_lock_key()
+    if cache.add(lock_key, True, app_settings.PATH_CACHE_LOCK_TIMEOUT):
+        try:
+            return _build_section_path_map(version)
+        finally:
+            cache.delete(lock_key)
+    if not wait:
+        return None
+    deadline = time.time() + app_settings.PATH_CACHE_LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        paths = cache.get(app_settings.PATH_CACHE_KEY)
+        if paths is not None:
+            return paths
+    return _build_section_path_map(version)
+
+def _is_path_map_stale(paths):
+    soft_ttl = app_settings.PATH_CACHE_SOFT_TTL
+    return bool(soft_ttl and paths.built_at and \
+        time.time() > paths.built_at + soft_ttl)
+
+def _get_path_map_check_time(paths):
+    """
+    Returns the time after which the local copy of the given index should be
+    fetched again, or None if it can be used until the tree version changes.
+    """
+    soft_ttl = app_settings.PATH_CACHE_SOFT_TTL
+    if not (soft_ttl and paths.built_at):
+        return None
+    if _is_path_map_stale(paths):
+        # Another process holds the lock and is rebuilding the index; rather
+        # than fetching the stale one again for every request, check back
+        # once it should be done.
+        return time.time() + app_settings.PATH_CACHE_LOCK_WAIT
+    return paths.built_at + soft_ttl
+
+def _fetch_section_path_map():
+    """
+    Retrieves (and, if necessary, first populates) the index of all section
+    urls from Django's low level cache.
+
+    If ``PATH_CACHE_SOFT_TTL`` is set and the cached index is older than
+    that, one process rebuilds it while the others keep using the old one.
     """
     paths = cache.get(app_settings.PATH_CACHE_KEY)
-    if not paths:
-        paths = _build_section_path_map()
+    if paths is None:
+        return _rebuild_section_path_map()
+    if _is_path_map_stale(paths):
+        return _rebuild_section_path_map(wait=False) or paths
+    return paths
+
+def _get_section_path_map(version=None):
+    """
+    Simple wrapper around Django's low level cache; retrieves (and, if 
+    necessary, first populates) an index of all section urls.
+
+    If ``LOCAL_PATH_CACHE`` is set, a copy of the index is kept in the
+    current process, and only fetched from the cache again after the tree
+    version changes (or, with ``PATH_CACHE_SOFT_TTL``, once it's stale).
+    Checking the version is a single, tiny cache read, which can be skipped
+    by passing in the current tree version.
+    """
+    global _local_path_map
+    if not app_settings.LOCAL_PATH_CACHE:
+        return _fetch_section_path_map()
+    if version is None:
+        version = get_tree_version()
+    local_version, paths, check_time = _local_path_map
+    if local_version == version and \
+        (check_time is None or time.time() <= check_time):
+        return paths
+    with _local_path_map_lock:
+        # Another thread may have fetched the index while we waited.
+        local_version, paths, check_time = _local_path_map
+        if local_version != version or \
+            (check_time is not None and time.time() > check_time):
+            # The index is always stored before the version is bumped, so
+            # whatever we fetch now is at least as new as this version.
+            paths = _fetch_section_path_map()
+            _local_path_map = (
+                version, paths, _get_path_map_check_time(paths)
+            )
+    return paths
+
+def _get_lazy_section(pk):
+    """
+    Returns a ``LazySection`` built from the cached record of the section
+    with the given primary key. If the record has fallen out of the cache,
+    the section is loaded and its record is cached again.
+    """
+    Section = app_settings.get_extending_model()
+    record = cache.get(_get_section_record_key(pk))
+    if record is None:
+        try:
+            section = Section.objects.get(pk=pk)
+        except Section.DoesNotExist:
+            return None
+        record = get_section_record(section)
         cache.set(
-            app_settings.PATH_CACHE_KEY, 
-            paths, app_settings.PATH_CACHE_TTL
+            _get_section_record_key(pk),
+            record,
+            app_settings.PATH_CACHE_TTL
         )
-    return paths
+    return LazySection(Section, record)
+
+def _get_request_section(request):
+    """
+    Returns the section the given request belongs to, looking it up the
+    first time it's asked for and storing it on the request itself.
+    """
+    try:
+        return request._scaffold_section
+    except AttributeError:
+        section = None
+        if _is_section_path(request.path):
+            section = lookup_section(request)
+        request._scaffold_section = section
+        return section
 
-def get_current_section():
+def get_current_section(request=None):
     """
     Convenience function to get the current section from the thread of the
     currently executing request, assuming there is one. If not, returns None.
+    The section is looked up the first time this function is called during
+    a request.
     NB: Make sure that the SectionsMiddleware is enabled before calling this
     function. If it is not enabled, this function will raise a
     MiddlewareNotUsed exception. 
+
+    If you have the request at hand, pass it in. The section is then looked
+    up from (and stored on) that request, which doesn't depend on the
+    middleware or on the current thread at all.
    
     """
+    if request is not None:
+        return _get_request_section(request)
     if not getattr(_thread_locals, 'scaffold_middleware_enabled', None):
         raise MiddlewareNotUsed, (
             'SectionsMiddleware is not used in this server configuration. '
             'Please enable the SectionsMiddleware.'
         )
-    return getattr(_thread_locals, 'section', None)
+    request = getattr(_thread_locals, 'request', None)
+    if request is None:
+        return None
+    return _get_request_section(request)
 
-def lookup_section(lookup_from):
+def lookup_section(lookup_from, nearest=None):
     """
     NB: `lookup_from` may either be an HTTP request, or a string representing an 
     integer.
+
+    When looking up from a request, only a section whose full path equals the
+    request path is returned, unless `nearest` is True (it defaults to the
+    ``RESOLVE_NEAREST_SECTION`` setting). In that case the deepest section
+    whose path is a prefix of the request path is returned.
+
+    If the ``CACHE_SECTION_RECORDS`` setting is True, a request lookup returns
+    a ``scaffold.paths.LazySection`` built from the cache, which only queries
+    the database if attributes other than pk, title, slug, full_path or depth
+    are accessed.
     """
     Section = app_settings.get_extending_model()
     if lookup_from.__class__.__name__ == "WSGIRequest":
-        path_map = _get_section_path_map()
-        section_paths = path_map.keys()
-        # Sort by shortest path to longest.
-        section_paths.sort(lambda x, y: len(x) <= len(y) and 1 or -1)
-        # Strips leading and trailing slashes
-        path = lookup_from.path.strip("/")
-        path_matches = [p for p in section_paths if path.startswith(p)]
-        if len(path_matches) >= 1 and path_map.has_key(path):
-            if app_settings.VALIDATE_GLOBALLY_UNIQUE_SLUGS:
-                # If slugs have to be globally unique, we can shortcut to a 
-                # more efficient query.
-                return Section.objects.get(slug=path_map[path])
-            else:
-                # If slugs are not unique, then we need to search through all 
-                # matches for the slug that actually matches our path.
-                sections = Section.objects.filter(slug=path_map[path])
-                if len(sections) == 1:
-                    return sections[0]
-                else:
-                    for section in sections:
-                        if section.full_path == path:
-                            return section
+        if nearest is None:
+            nearest = app_settings.RESOLVE_NEAREST_SECTION
+        version = get_tree_version()
+        miss_key = (lookup_from.path, nearest)
+        if _path_misses.contains(miss_key, version):
+            return None
+        path_map = _get_section_path_map(version)
+        match = path_map.match(lookup_from.path, nearest=nearest)
+        if match is None:
+            _path_misses.add(miss_key, version)
+        else:
+            path, pk = match
+            if app_settings.CACHE_SECTION_RECORDS:
+                return _get_lazy_section(pk)
+            try:
+                return Section.objects.get(pk=pk)
+            except Section.DoesNotExist:
+                pass
         return None
     else:
         try:
@@ -90,6 +274,18 @@ def lookup_section(lookup_from):
         except Section.DoesNotExist:
             return None
 
+def _is_section_path(path):
+    """
+    Returns True if the given request path may belong to a section, according
+    to the ``MIDDLEWARE_INCLUDE_PREFIXES`` and ``MIDDLEWARE_EXCLUDE_PREFIXES``
+    settings.
+    """
+    include = app_settings.MIDDLEWARE_INCLUDE_PREFIXES
+    if include is not None and not path.startswith(tuple(include)):
+        return False
+    exclude = app_settings.MIDDLEWARE_EXCLUDE_PREFIXES
+    return not (exclude and path.startswith(tuple(exclude)))
+
 class SectionsMiddleware(object):
     """
     Middleware that stores the current section (if any) in the thread of the 
@@ -98,25 +294,336 @@ class SectionsMiddleware(object):
     
     def process_request(self, request):
         """
-        Determine the section from the request and store it in the currently 
-        executing thread where anyone can grab it (remember, in Django, 
-        there's one request per thread)."""
-        section = lookup_section(request)
+        Store the request in the currently executing thread, so the section
+        can be determined from it when anyone first asks for it with
+        get_current_section (remember, in Django, there's one request per
+        thread). Requests for paths which can't belong to a section never
+        have one.
+        """
         _thread_locals.scaffold_middleware_enabled = True
-        _thread_locals.section = section
+        _thread_locals.request = request
+
+    def process_response(self, request, response):
+        """
+        Forget the request once it's been handled, so nothing that runs in
+        this thread afterwards sees its section.
+        """
+        _thread_locals.request = None
+        return response
 
 def reset_section_path_map(sender, **kwargs):
+    """
+    Rebuilds the whole path map. Not connected to any signal (sections are
+    maintained incrementally, see below), but can be used as a receiver or
+    called after changing sections behind the ORM's back.
+    """
     _build_section_path_map()
+    bump_tree_version()
 
-# Rebuild path map when a section is saved or removed.
+def _is_deferring_section_changes(using=None):
+    """
+    Returns True if the path map should not be updated for section changes
+    right away. That's the case inside ``batch_section_changes``, and, if
+    ``DEFER_PATH_MAP_UPDATES`` is set, while changes are part of a
+    transaction that hasn't been committed yet.
+    """
+    if getattr(_pending_changes, 'depth', 0):
+        return True
+    if not app_settings.DEFER_PATH_MAP_UPDATES:
+        return False
+    if using is None:
+        using = router.db_for_write(app_settings.get_extending_model())
+    return transaction.is_managed(using=using)
+
+def _defer_section_change(pk, moved, using=None):
+    """
+    Returns True (and notes the change, to be applied by
+    ``flush_section_changes``) if the path map should not be updated for a
+    change to the section with the given primary key right away. ``moved``
+    is True if the change affects the section's path (it was added, removed,
+    moved or had its slug changed), and False if it only affects the
+    section's cached record.
+    """
+    if not _is_deferring_section_changes(using):
+        return False
+    if moved and getattr(_pending_changes, 'depth', 0):
+        # The whole map is rebuilt once the batch exits.
+        _pending_changes.dirty = True
+    else:
+        if not hasattr(_pending_changes, 'changes'):
+            _pending_changes.changes = []
+        _pending_changes.changes.append((pk, moved))
+    return True
+
+def _replay_section_changes(changes):
+    """
+    Applies deferred section changes, given as ``(pk, moved)`` tuples (see
+    ``_defer_section_change``), to the path map and the cached section
+    records. Each changed section is read from the database again, so
+    changes which were rolled back in the meantime are left out, and is
+    looked up in the map by its primary key, wherever earlier changes put
+    it.
+    """
+    Section = app_settings.get_extending_model()
+    pks = []
+    moved_pks = set()
+    for pk, moved in changes:
+        if pk not in pks:
+            pks.append(pk)
+        if moved:
+            moved_pks.add(pk)
+    sections = Section.objects.in_bulk(pks)
+    full_paths = dict(
+        (pk, section._build_full_path())
+        for pk, section in sections.items()
+    )
+    if app_settings.CACHE_SECTION_RECORDS:
+        records = dict(
+            (_get_section_record_key(pk), get_section_record(
+                section, full_paths[pk]
+            )) for pk, section in sections.items()
+        )
+        if records:
+            cache.set_many(records, app_settings.PATH_CACHE_TTL)
+        cache.delete_many([
+            _get_section_record_key(pk) for pk in pks if pk not in sections
+        ])
+    if not moved_pks:
+        return
+
+    def change(paths):
+        current_paths = dict((pk, path) for path, pk in paths.items())
+        for pk in pks:
+            old_path = current_paths.get(pk)
+            full_path = full_paths.get(pk)
+            if pk not in moved_pks or old_path == full_path:
+                continue
+            if old_path is None:
+                paths[full_path] = pk
+                current_paths[pk] = full_path
+            elif full_path is None:
+                for path, removed_pk in paths.pop_subtree(old_path):
+                    current_paths.pop(removed_pk, None)
+            else:
+                moved = paths.move_subtree(old_path, full_path)
+                for path, moved_pk in moved:
+                    current_paths[moved_pk] = path
+                if app_settings.CACHE_SECTION_RECORDS:
+                    _update_section_records(moved)
+    _change_section_path_map(change)
+
+def flush_section_changes(**kwargs):
+    """
+    Applies the section changes deferred in the current thread, if any. If
+    sections were added, removed or moved in a batch, the path map is
+    rebuilt once; otherwise the changes are applied to it one by one. This
+    is connected to the ``request_finished`` signal, so changes made in a
+    view are picked up after its transaction commits. Call it yourself after
+    committing changes made outside of a request.
+    """
+    if getattr(_pending_changes, 'depth', 0):
+        return
+    changes = getattr(_pending_changes, 'changes', None)
+    _pending_changes.changes = []
+    if getattr(_pending_changes, 'dirty', False):
+        _pending_changes.dirty = False
+        _build_section_path_map()
+        bump_tree_version()
+    elif changes:
+        _replay_section_changes(changes)
+
+@contextmanager
+def batch_section_changes():
+    """
+    A context manager which suspends path map maintenance while sections are
+    changed in bulk, and rebuilds the map once (if anything changed) when
+    the outermost batch exits::
+
+        with batch_section_changes():
+            for data in taxonomy:
+                ...
+
+    The rebuild reads the tree from the database, so when changes are made
+    in a transaction, enter the batch outside of it.
+    """
+    _pending_changes.depth = getattr(_pending_changes, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _pending_changes.depth -= 1
+        flush_section_changes()
+
+def _update_section_records(paths):
+    """
+    Rewrites the full path and depth of the cached records of the sections
+    found at the given ``(full path, pk)`` tuples.
+    """
+    keys = dict(
+        (_get_section_record_key(pk), path) for path, pk in paths
+    )
+    records = cache.get_many(keys.keys())
+    for key, record in records.items():
+        full_path = keys[key]
+        records[key] = record[:3] + (full_path, len(split_path(full_path)))
+    if records:
+        cache.set_many(records, app_settings.PATH_CACHE_TTL)
+
+def _change_section_path_map(change):
+    """
+    Applies an incremental change to the cached path map, then bumps the
+    tree version. ``change`` is called with the map, and modifies it in
+    place. The map is read, changed and stored again under the same lock as
+    rebuilds, so that concurrent changes don't overwrite each other. If
+    another process holds the lock, the map is dropped instead, to be
+    rebuilt when it's next needed.
+    """
+    lock_key = _get_path_map_lock_key()
+    if not cache.add(lock_key, True, app_settings.PATH_CACHE_LOCK_TIMEOUT):
+        # The version is bumped both before and after the map is dropped, so
+        # that neither a rebuild in progress nor a process fetching the old
+        # map in between keeps it.
+        bump_tree_version()
+        cache.delete(app_settings.PATH_CACHE_KEY)
+        bump_tree_version()
+        return
+    try:
+        paths = cache.get(app_settings.PATH_CACHE_KEY)
+        # If there's no map, it will be built when it's next needed. Local
+        # copies of it have to be dropped all the same.
+        if paths is not None:
+            change(paths)
+            cache.set(
+                app_settings.PATH_CACHE_KEY,
+                paths,
+                app_settings.PATH_CACHE_TTL
+            )
+    finally:
+        cache.delete(lock_key)
+    bump_tree_version()
+
+def remember_section_slug(sender, instance, **kwargs):
+    """
+    Before a section is saved, note its slug as it is stored in the database
+    so a changed slug can be detected afterwards.
+    """
+    instance._scaffold_old_slug = None
+    if kwargs.get('raw') or instance.pk is None:
+        return
+    try:
+        instance._scaffold_old_slug = sender.objects.filter(
+            pk=instance.pk
+        ).values_list('slug', flat=True)[0]
+    except IndexError:
+        pass
+
+def remember_section_path(sender, instance, **kwargs):
+    """
+    Before a section is deleted, note its full path (its ancestors may be
+    deleted along with it) so it can be removed from the path map afterwards.
+    """
+    instance._scaffold_old_path = None
+    if not _is_deferring_section_changes(kwargs.get('using')):
+        instance._scaffold_old_path = instance._build_full_path()
+
+def update_section_path_map(sender, instance, **kwargs):
+    """
+    Updates the path map after a section is saved. A new section is added to
+    the map and a changed slug moves the section's subtree within it; saving
+    a section never moves it. Other changes leave the map alone (only the
+    section's cached record, if any, is rewritten). Whenever the map
+    changes, the tree version is bumped.
+    """
+    if kwargs.get('raw'):
+        # Fixture loading; the tree may not be consistent yet.
+        cache.delete(app_settings.PATH_CACHE_KEY)
+        bump_tree_version()
+        return
+    created = kwargs.get('created')
+    old_slug = getattr(instance, '_scaffold_old_slug', None)
+    slug_changed = old_slug is not None and old_slug != instance.slug
+    if not created and not slug_changed and \
+        not app_settings.CACHE_SECTION_RECORDS:
+        return
+    if _defer_section_change(
+        instance.pk, created or slug_changed, kwargs.get('using')):
+        return
+    full_path = instance._build_full_path()
+    if app_settings.CACHE_SECTION_RECORDS:
+        cache.set(
+            _get_section_record_key(instance.pk),
+            get_section_record(instance, full_path),
+            app_settings.PATH_CACHE_TTL
+        )
+    if not created and not slug_changed:
+        return
+    if slug_changed:
+        old_path = "/".join(split_path(full_path)[:-1] + [old_slug])
+
+    def change(paths):
+        if not slug_changed or old_path not in paths:
+            paths[full_path] = instance.pk
+        else:
+            moved = paths.move_subtree(old_path, full_path)
+            if app_settings.CACHE_SECTION_RECORDS:
+                _update_section_records(moved)
+    _change_section_path_map(change)
+
+def move_section_path_map(sender, instance, old_path, **kwargs):
+    """
+    Moves a section's subtree within the path map after the section is moved
+    within the tree.
+    """
+    if _defer_section_change(instance.pk, True):
+        return
+    full_path = sender.objects.get(pk=instance.pk)._build_full_path()
+    if old_path == full_path:
+        return
+
+    def change(paths):
+        moved = paths.move_subtree(old_path, full_path)
+        if app_settings.CACHE_SECTION_RECORDS:
+            _update_section_records(moved)
+    _change_section_path_map(change)
+
+def remove_section_path_map(sender, instance, **kwargs):
+    """
+    Removes a section (and any descendants still in it) from the path map
+    after the section is deleted.
+    """
+    if _defer_section_change(instance.pk, True, kwargs.get('using')):
+        return
+    cache.delete(_get_section_record_key(instance.pk))
+    old_path = getattr(instance, '_scaffold_old_path', None)
+
+    def change(paths):
+        if old_path is not None and old_path in paths:
+            paths.pop_subtree(old_path)
+    _change_section_path_map(change)
+
+# Update the path map when a section is saved, moved or removed.
 # See http://code.djangoproject.com/wiki/[...]
 # Signals#Helppost_saveseemstobeemittedtwiceforeachsave
 # for an explanation of why dispatch_uid is needed.
-post_save.connect(reset_section_path_map, 
+pre_save.connect(remember_section_slug,
+    sender=app_settings.get_extending_model(),
+    dispatch_uid="paths-remember"
+)
+post_save.connect(update_section_path_map, 
     sender=app_settings.get_extending_model(), 
     dispatch_uid="paths-reset"
 )
-post_delete.connect(reset_section_path_map, 
+section_moved.connect(move_section_path_map,
+    sender=app_settings.get_extending_model(),
+    dispatch_uid="paths-move"
+)
+pre_delete.connect(remember_section_path,
+    sender=app_settings.get_extending_model(),
+    dispatch_uid="paths-remember"
+)
+post_delete.connect(remove_section_path_map, 
     sender=app_settings.get_extending_model(), 
     dispatch_uid="paths-reset"
 )
+request_finished.connect(flush_section_changes,
+    dispatch_uid="paths-flush"
+)
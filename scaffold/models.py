@@ -1,14 +1,76 @@
+from bisect import bisect_left
+from hashlib import md5
+import operator
+
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db import models
+from django.core.cache import cache
+from django.db import connections, models
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 
+from treebeard.al_tree import AL_Node
 from treebeard.mp_tree import MP_Node
+from treebeard.ns_tree import NS_Node
 
 import app_settings
+from content import _get_label, _get_content_type_ids, \
+    _get_generic_objects, _get_generic_querysets, _get_sort_value, \
+    ContentItem, get_content_relations, merge_content_streams, \
+    run_in_parallel
+from paths import LazySection
+from signals import section_moved
+from tree import get_section_tree as _get_section_tree
+from versions import get_tree_version, get_sections_version, \
+    bump_sections_version
 
 Treebeard_Base_Class = app_settings.get_treebeard_node_class()
 
+def _count_nested_set_children(model, sections):
+    """
+    Returns ``(pk, number of children)`` tuples for the given nested set
+    sections, with a single query for all of them. The lft of every
+    child are fetched, and each is counted against the bounds of its 
+    parent. Leaves (whose rgt follows their lft) are left out.
+    """
+    parents = [
+        section for section in sections if section.rgt - section.lft > 1
+    ]
+    if len(parents) == 0:
+        return []
+    query = reduce(operator.or_, [
+        models.Q(
+            tree_id=section.tree_id,
+            lft__gt=section.lft,
+            rgt__lt=section.rgt,
+            depth=section.depth + 1
+        ) for section in parents
+    ])
+    lfts = {}
+    for tree_id, depth, lft in model.objects.filter(query).order_by(
+        'lft').values_list('tree_id', 'depth', 'lft'):
+        lfts.setdefault((tree_id, depth), []).append(lft)
+    children = []
+    for section in parents:
+        child_lfts = lfts.get((section.tree_id, section.depth + 1), [])
+        children.append((
+            section.pk, 
+            bisect_left(child_lfts, section.rgt) - 
+            bisect_left(child_lfts, section.lft)
+        ))
+    return children
+
+def _get_content_fetcher(relation, fk_items):
+    """
+    Returns a function which loads the content objects of the given items
+    of a relation. If this is a generic relation, the content objects are
+    fetched with one query per content type.
+    """
+    if relation.is_generic:
+        return lambda: _get_generic_objects(fk_items, relation.generic_fk)
+    return lambda: list(fk_items)
+
 class BaseSection(Treebeard_Base_Class):
     """
     An abstract model of a section or subsection. This class provides a base
@@ -32,13 +94,169 @@ class BaseSection(Treebeard_Base_Class):
     def __unicode__(self):
         indent_string = "-" * (self.get_depth() - 1)
         return indent_string + self.title
+
+    def __eq__(self, other):
+        # Django's Model.__eq__ doesn't defer to other types, so sections
+        # compare equal to their LazySection stand-ins here.
+        if isinstance(other, LazySection):
+            return other == self
+        return super(BaseSection, self).__eq__(other)
         
     @property
     def full_path(self):
+        if app_settings.USE_SECTION_TREE:
+            tree = self.get_section_tree()
+            if self.pk in tree:
+                # The section's own slug may have changed since it was saved.
+                parent = tree.get_parent(self.pk)
+                if parent is None:
+                    return self.slug
+                return tree.get_full_path(parent) + "/" + self.slug
+        return self._build_full_path()
+
+    def _build_full_path(self):
+        """
+        Builds the full path of the section from its ancestors, never from 
+        the tree snapshot. Every change to a section replaces the snapshot, 
+        so code which runs while sections are being changed (e.g. path map 
+        maintenance) uses this rather than full_path, which would rebuild 
+        the snapshot for every change.
+        """
         section_path = [node.slug for node in self.get_ancestors()] 
         section_path.append(self.slug)
         return "/".join(section_path)
+
+    @classmethod
+    def get_section_tree(cls):
+        """
+        Returns an in-memory snapshot of the whole section tree (see 
+        scaffold.tree.SectionTree), which answers navigation reads such as 
+        children, ancestors, descendants and full paths without queries. 
+        It is rebuilt with a single query whenever any section changes.
+        """
+        return _get_section_tree(cls)
+
+    @classmethod
+    def get_root_sections(cls):
+        """
+        Returns the list of root sections, in tree order. The list is cached 
+        until any section changes, so it usually costs no queries.
+        """
+        cache_key = "%s-roots-%s" % (
+            app_settings.PATH_CACHE_KEY,
+            cls._meta.app_label + "." + cls._meta.object_name
+        )
+        version = (get_tree_version(), get_sections_version())
+        cached = cache.get(cache_key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        root_sections = list(cls.get_root_nodes())
+        cache.set(
+            cache_key, 
+            (version, root_sections), 
+            app_settings.PATH_CACHE_TTL
+        )
+        return root_sections
+
+    def is_descendant_of(self, node):
+        """
+        Returns True if the section is a descendant of the given node. With 
+        SCAFFOLD_USE_SECTION_TREE, this is answered from the tree snapshot 
+        (except while the node is being moved, when treebeard asks this to 
+        check the target and the snapshot is about to be replaced anyway).
+        """
+        if app_settings.USE_SECTION_TREE and \
+            not getattr(node, '_scaffold_moving', False):
+            tree = self.get_section_tree()
+            if self.pk in tree and node.pk in tree:
+                return tree.is_descendant_of(self.pk, node.pk)
+        return super(BaseSection, self).is_descendant_of(node)
     
+    @classmethod
+    def get_tree_rows(cls, *fields):
+        """
+        Returns a list of tuples, one for every section in the tree, in
+        depth-first tree order::
+
+            (pk, parent pk, depth, field value, field value, ...)
+
+        ...where the trailing values are those of the given field names. The
+        parent pk of a root section is ``None``. The whole tree is loaded with
+        a single query, whichever treebeard node type is used.
+        """
+        rows = []
+        if issubclass(cls, MP_Node):
+            pks_by_path = {}
+            for row in cls.objects.order_by('path').values_list(
+                'pk', 'path', 'depth', *fields):
+                pk, path, depth = row[:3]
+                pks_by_path[path] = pk
+                parent = pks_by_path.get(path[:-cls.steplen])
+                rows.append((pk, parent, depth) + row[3:])
+        elif issubclass(cls, NS_Node):
+            # A stack of (rgt, pk) tuples for the ancestors of the current row.
+            ancestors = []
+            for row in cls.objects.order_by('tree_id', 'lft').values_list(
+                'pk', 'tree_id', 'lft', 'rgt', 'depth', *fields):
+                pk, tree_id, lft, rgt, depth = row[:5]
+                if lft == 1:
+                    ancestors = []
+                while ancestors and ancestors[-1][0] < lft:
+                    ancestors.pop()
+                parent = ancestors and ancestors[-1][1] or None
+                ancestors.append((rgt, pk))
+                rows.append((pk, parent, depth) + row[5:])
+        elif issubclass(cls, AL_Node):
+            # The default manager already orders siblings correctly.
+            children = {}
+            for row in cls.objects.values_list('pk', 'parent', *fields):
+                children.setdefault(row[1], []).append(row)
+            stack = [(row, 1) for row in reversed(children.get(None, []))]
+            while stack:
+                row, depth = stack.pop()
+                rows.append(row[:2] + (depth,) + row[2:])
+                for child in reversed(children.get(row[0], [])):
+                    stack.append((child, depth + 1))
+        return rows
+
+    @classmethod
+    def get_path_records(cls):
+        """
+        Returns a list of ``(pk, title, slug, full path, depth)`` tuples for
+        every section in the tree, in tree order. Unlike reading the
+        ``full_path`` property of each section, which queries for that
+        section's ancestors, this costs one query for the whole tree.
+        """
+        full_paths = {}
+        records = []
+        for pk, parent, depth, title, slug in cls.get_tree_rows(
+            'title', 'slug'):
+            if parent is None:
+                full_path = slug
+            else:
+                full_path = full_paths[parent] + "/" + slug
+            full_paths[pk] = full_path
+            records.append((pk, title, slug, full_path, depth))
+        return records
+
+    def move(self, target, pos=None):
+        """
+        Moves the section (and its descendants) relative to the target node.
+        See treebeard's documentation for the possible positions. Sends the
+        ``scaffold.signals.section_moved`` signal once the move is done.
+        """
+        old_path = self._build_full_path()
+        self._scaffold_moving = True
+        try:
+            super(BaseSection, self).move(target, pos)
+        finally:
+            self._scaffold_moving = False
+        section_moved.send(
+            sender=self.__class__,
+            instance=self,
+            old_path=old_path
+        )
+
     @models.permalink
     def get_absolute_url(self):
         return ("section", (), {'section_path': self.full_path})
@@ -47,9 +265,15 @@ class BaseSection(Treebeard_Base_Class):
     def type(self):
         """
         A property that returns the string 'section' if the section is at the 
-        root of the tree, 'subsection' otherwise.
+        root of the tree, 'subsection' otherwise. With 
+        SCAFFOLD_USE_SECTION_TREE, this is answered from the tree snapshot.
         """
-        return self.is_root and 'section' or 'subsection'    
+        if app_settings.USE_SECTION_TREE:
+            tree = self.get_section_tree()
+            if self.pk in tree:
+                is_root = tree.get_parent(self.pk) is None
+                return is_root and 'section' or 'subsection'
+        return self.is_root() and 'section' or 'subsection'    
     
     def get_first_populated_field(self, field_name):
         """
@@ -57,17 +281,61 @@ class BaseSection(Treebeard_Base_Class):
         sections tree. Will crawl from leaf to root, returning `None` if no 
         non-empty field is encountered.
         """
-        assert hasattr(self, field_name), "Field name does not exist."
-        node = self
-        if getattr(node, field_name, None):
-            return getattr(node, field_name)
-        while not node.is_root():
-            node = node.get_parent()
-            if getattr(node, field_name, None):
-                return getattr(node, field_name)            
-        return None
+        return self.get_inherited_fields(field_name)[field_name]
+
+    def get_inherited_fields(self, *field_names):
+        """
+        Resolves several inherited fields at once. Returns a dictionary that 
+        maps each of the given field names to its first non-empty value in 
+        the sections tree, crawling from leaf to root (see 
+        get_first_populated_field)::
+
+            section.get_inherited_fields('banner', 'ad_zone', 'template')
+
+        The ancestors of the section are fetched once, with a single query 
+        for materialized path and nested set trees, however many fields are 
+        resolved. If SCAFFOLD_INHERITED_FIELDS_CACHE_TTL is set, the result 
+        is cached per section until any section changes.
+        """
+        for field_name in field_names:
+            assert hasattr(self, field_name), "Field name does not exist."
+        cache_key = None
+        if app_settings.INHERITED_FIELDS_CACHE_TTL:
+            cache_key = "%s-inherited-%s-%s-%s" % (
+                app_settings.PATH_CACHE_KEY,
+                _get_label(self),
+                self.pk,
+                md5(",".join(sorted(field_names))).hexdigest()
+            )
+            version = (get_tree_version(), get_sections_version())
+            cached = cache.get(cache_key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        values = {}
+        missing = []
+        for field_name in field_names:
+            values[field_name] = getattr(self, field_name, None) or None
+            if values[field_name] is None:
+                missing.append(field_name)
+        if missing:
+            # The nearest ancestor comes last.
+            for node in reversed(list(self.get_ancestors())):
+                for field_name in missing[:]:
+                    value = getattr(node, field_name, None)
+                    if value:
+                        values[field_name] = value
+                        missing.remove(field_name)
+                if not missing:
+                    break
+        if cache_key:
+            cache.set(
+                cache_key,
+                (version, values),
+                app_settings.INHERITED_FIELDS_CACHE_TTL
+            )
+        return values
     
-    def get_related_content(self, sort_fields=[], infer_sort=False):
+    def get_related_content(self, sort_fields=[], infer_sort=False, only=[]):
         """
         A method to access content associated with a section via a foreign-key 
         relationship of any type. This includes content that's attached via a 
@@ -75,7 +343,8 @@ class BaseSection(Treebeard_Base_Class):
         generic foreign key (for example, through a subclass of the  
         SectionItem model).
         
-        This method returns a list of tuples::
+        This method returns a list of ContentItem rows (see 
+        scaffold.content), which unpack like tuples::
         
             (object, app name, model name, relationship_type)
         
@@ -91,70 +360,74 @@ class BaseSection(Treebeard_Base_Class):
         
         This will create a common sort key on all assciated objects based on    
         the first of these fields that are present on the object, then sort 
-        the entire set based on that sort key. (NB: This key is temporary and 
-        is removed from the items before they are returned.) 
+        the entire set based on that sort key. 
         
         If 'infer_sort' is True, this will override the sort_fields options 
         and select each content type's sort field based on the first item in 
         the 'ordering' property of it's Meta class. Obviously, infer_sort will  
         only work if the types of fields that are being compared are the same.
+
+        To restrict the types of objects that are returned, pass a list of 
+        '{app name}.{model name}' items in via the only argument (see 
+        get_associated_content). Relations to other types of objects are not 
+        queried at all.
         
         """
         associated_content = []
-        object_ids = []
+        object_ids = set()
         if infer_sort:
             sort_fields = set()
-        for rel in self._meta.get_all_related_objects():
-            try: 
-                fk_items = getattr(self, rel.get_accessor_name())
-            except self.DoesNotExist:
+        content_type_ids = _get_content_type_ids(only)
+        fetches = []
+        for relation in get_content_relations(self):
+            if not relation.is_wanted(only, content_type_ids):
                 continue
-            else:
-                for fk_item in fk_items.all():
-                    # If this is a generic relation, fetch content object.
-                    if hasattr(fk_item, 'content_object'):
-                        fk_item = fk_item.content_object    
-                        relationship_type = 'generic-foreign-key'
-                    else:
-                        relationship_type = 'foreign-key'
-                    # In the weird edge-case where an item is related to a 
-                    # section in more than one way, we only want the item to 
-                    # appear in this list once. Therefore, we ID items by app, 
-                    # model and pk and verify we haven't already seen that ID 
-                    # before adding the item to our list.
-                    object_id = "%s/%s/%s" % (
-                        fk_item._meta.app_label,
-                        fk_item._meta.object_name,
-                        str(fk_item.pk)
+            fk_items = relation.get_items(self, content_type_ids)
+            if fk_items is not None:
+                fetches.append(
+                    (relation, _get_content_fetcher(relation, fk_items))
+                )
+        # The relations are independent of each other, so they may be
+        # fetched at the same time; the results are merged in order.
+        results = run_in_parallel(
+            [fetch for relation, fetch in fetches],
+            app_settings.PARALLEL_CONTENT_QUERIES,
+            self._state.db
+        )
+        for (relation, fetch), fk_items in zip(fetches, results):
+            relationship_type = relation.relationship_type
+            for fk_item in fk_items:
+                # In the weird edge-case where an item is related to a 
+                # section in more than one way, we only want the item to 
+                # appear in this list once. Therefore, we ID items by app, 
+                # model and pk and verify we haven't already seen that ID 
+                # before adding the item to our list.
+                object_id = (
+                    fk_item._meta.app_label,
+                    fk_item._meta.object_name,
+                    fk_item.pk
+                )
+                if object_id not in object_ids:
+                    object_ids.add(object_id)
+                    associated_content.append(
+                        (fk_item, relationship_type)
                     )
-                    if object_id not in object_ids:
-                        object_ids.insert(0, object_id)
-                        associated_content.insert(0,(
-                            fk_item, 
-                            fk_item._meta.app_label,
-                            fk_item._meta.object_name,
-                            relationship_type                    
-                        ))
-                        if infer_sort and len(fk_item._meta.ordering) > 0:
-                            sort_fields.add(fk_item._meta.ordering[0])
+                    if infer_sort and len(fk_item._meta.ordering) > 0:
+                        sort_fields.add(fk_item._meta.ordering[0])
+        # Most recently found items come first.
+        associated_content.reverse()
+        # The sort fields are only all known (if inferred) once every item
+        # has been seen.
+        associated_content = [
+            ContentItem(
+                fk_item,
+                relationship_type,
+                _get_sort_value(fk_item, sort_fields)
+            )
+            for fk_item, relationship_type in associated_content
+        ]
         if not len(sort_fields) == 0:
-            for item, app, model, rel in associated_content:
-                for sort_field in sort_fields:
-                    if hasattr(item, sort_field):
-                        key = getattr(item, sort_field)
-                        setattr(item, '_associated_content_tmp_sort_key', key)
-                        break
-            
-            def sort_content(x, y):
-                return cmp(
-                    getattr(x[0], '_associated_content_tmp_sort_key', None),
-                    getattr(y[0], '_associated_content_tmp_sort_key', None)
-                )
-            
-            associated_content.sort(sort_content)
-            for item in associated_content:
-                if hasattr(item, '_associated_content_tmp_sort_key'):
-                    delattr(item, '_associated_content_tmp_sort_key')
+            associated_content.sort(key=lambda item: item.sort_key)
         return associated_content
 
     def get_subsections(self):
@@ -190,52 +463,292 @@ class BaseSection(Treebeard_Base_Class):
             )
             
         ...and the list returned would be sorted by the 'order' field.
+
+        Like get_related_content, this returns ContentItem rows. The 
+        '{app name}.{model name}' label of each object is available as the 
+        row's content_type attribute; the objects themselves are not 
+        modified.
         """
         
-        related_content = self.get_related_content()
-        associated_content = []
-        if len(only) != 0:
-            for obj, app, model, rel in related_content:
-                if "%s.%s" % (app, model) in only:
-                        setattr(obj, 'content_type', "%s.%s" % (app, model))
-                        associated_content.insert(0, (
-                            obj,
-                            app,
-                            model,
-                            rel
-                        ))
-        else:
-            for obj, app, model, rel in related_content:
-                setattr(obj, 'content_type', "%s.%s" % (app, model))
-                associated_content.insert(0, (
-                    obj,
-                    app,
-                    model,
-                    rel
-                ))
-        for subsection in self.get_subsections():
-            app = subsection._meta.app_label
-            model = subsection._meta.object_name
-            if len(only) == 0 or app + "." + model in only: 
-                associated_content.insert(0, (
+        sort_fields = sort_key and [sort_key] or []
+        related_content = self.get_related_content(
+            sort_fields=sort_fields,
+            only=only
+        )
+        associated_content = [
+            item for item in related_content
+            if len(only) == 0 or item.content_type in only
+        ]
+        # Unlike get_related_content, related objects are listed in the
+        # order they were found.
+        associated_content.reverse()
+        if len(only) == 0 or _get_label(self) in only:
+            subsections = [
+                ContentItem(
                     subsection,
-                    app,
-                    model,
-                    'subsection'
-                ))
-
-        def sort_list(x, y):
-            if not hasattr(x[0], sort_key):
-                if not hasattr(y[0], sort_key):
-                    return x
-                else:
-                    return y
-            return cmp(getattr(x[0],sort_key),getattr(y[0],sort_key))
+                    'subsection',
+                    _get_sort_value(subsection, sort_fields)
+                )
+                for subsection in self.get_subsections()
+            ]
+            subsections.reverse()
+            associated_content = subsections + associated_content
 
         if sort_key:
-            associated_content.sort(cmp=sort_list)
+            # Objects without the sort key go last.
+            associated_content.sort(key=lambda item: (
+                not hasattr(item.object, sort_key),
+                item.sort_key
+            ))
         return associated_content
 
+    def get_content_counts(self, only=[]):
+        """
+        Returns a dictionary mapping the '{app name}.{model name}' label of
+        each type of content associated with the section (including
+        subsections) to the number of such items, without loading any of
+        them::
+
+            section.get_content_counts()
+            # {'articles.Article': 12, 'sections.Section': 3}
+
+        Types without any content are left out. The only argument restricts
+        the types that are counted, as for get_associated_content. Each
+        relation costs one COUNT query; generic relations are grouped by
+        content type. Note that items are counted per relation, so an object
+        related to the section in more than one way is counted more than
+        once.
+        """
+        return self.__class__.get_content_counts_for([self], only)[self.pk]
+
+    @classmethod
+    def get_content_counts_for(cls, sections, only=[]):
+        """
+        Counts the associated content of each of the given sections (e.g.
+        the result of get_subsections), with one grouped query per relation
+        for all of them. Returns a dictionary mapping the pk of each section
+        to its content counts (see get_content_counts). Subsections are 
+        counted without a query for materialized path trees, and with a 
+        single query for other trees.
+        """
+        counts = dict([(section.pk, {}) for section in sections])
+        if len(counts) == 0:
+            return counts
+        section_pks = counts.keys()
+        content_type_ids = _get_content_type_ids(only)
+        for relation in get_content_relations(cls):
+            if not relation.is_wanted(only, content_type_ids):
+                continue
+            if issubclass(cls, AL_Node) and relation.model is cls and \
+                relation.field_name == 'parent':
+                # The tree's own parent links; subsections are counted below.
+                continue
+            for section_pk, label, count in relation.count_items(
+                section_pks, content_type_ids):
+                if len(only) != 0 and label not in only:
+                    continue
+                section_counts = counts[section_pk]
+                section_counts[label] = section_counts.get(label, 0) + count
+        label = _get_label(cls)
+        if len(only) == 0 or label in only:
+            if issubclass(cls, MP_Node):
+                # Materialized path nodes keep count of their children.
+                children = [
+                    (section.pk, section.numchild) for section in sections
+                ]
+            elif issubclass(cls, AL_Node):
+                children = cls.objects.filter(
+                    parent__in=section_pks
+                ).order_by().values_list('parent').annotate(Count('pk'))
+            else:
+                children = _count_nested_set_children(cls, sections)
+            for section_pk, count in children:
+                if count:
+                    section_counts = counts[section_pk]
+                    section_counts[label] = section_counts.get(label, 0) + count
+        return counts
+
+    def iter_associated_content(self, sort_key, only=[], offset=0,
+        limit=None):
+        """
+        Returns an iterator over the same content as get_associated_content,
+        sorted on the given sort key (a field name, optionally prefixed with
+        '-' to sort in descending order). Like get_associated_content, it
+        yields ContentItem rows::
+
+            (object, app name, model name, relationship_type)
+
+        Rather than loading all associated content and sorting it in memory,
+        each relation (and each content type of a generic relation) is
+        sorted in the database and read lazily, and the sorted streams are
+        merged. To fetch a page of content, pass offset and limit; only the
+        rows needed for that page are read from each relation::
+
+            section.iter_associated_content('order', offset=40, limit=20)
+
+        Objects without the sort field come after all others.
+        """
+        streams = self._get_content_streams(only)
+        return merge_content_streams(streams, sort_key, offset, limit)
+
+    def get_subtree_content(self, sort_key, only=[], offset=0, limit=None,
+        include_self=True):
+        """
+        Returns a list of ContentItem rows for the content associated with
+        the section or any of its descendants, including the descendant
+        sections themselves (as 'subsection' rows), sorted on the given sort
+        key as for iter_associated_content. For example, the 10 most recent
+        articles anywhere under a section::
+
+            section.get_subtree_content(
+                '-pub_date',
+                only=['articles.Article'],
+                limit=10
+            )
+
+        Each relation is filtered to the whole subtree within a single query
+        (see filter_subtree), sorted and limited in the database. If
+        include_self is False, content of the section itself is left out.
+        """
+        streams = self._get_content_streams(only, subtree=True,
+            include_self=include_self)
+        return list(merge_content_streams(streams, sort_key, offset, limit))
+
+    def get_latest_content(self, limit=10, only=[], subtree=True):
+        """
+        Returns a list of ContentItem rows for the newest content associated
+        with the section (or, if subtree is True, anywhere under it), newest
+        first, for example to show the 10 latest items of any type under a
+        "news" section::
+
+            section.get_latest_content(limit=10)
+
+        Only content of models with a ``get_latest_by`` Meta option is
+        included; each relation is sorted on that field and only its latest
+        ``limit`` items are read, so the cost doesn't depend on how much
+        content there is. The only argument works as for
+        get_associated_content.
+
+        If SCAFFOLD_LATEST_CONTENT_CACHE_TTL is set, the result is cached
+        per section for that long, or until the section tree changes.
+        """
+        cache_key = None
+        if app_settings.LATEST_CONTENT_CACHE_TTL:
+            cache_key = "%s-latest-%s-%s-%s-%s-%s" % (
+                app_settings.PATH_CACHE_KEY,
+                _get_label(self),
+                self.pk,
+                limit,
+                subtree and 'subtree' or 'section',
+                md5(",".join(sorted(only))).hexdigest()
+            )
+            version = get_tree_version()
+            cached = cache.get(cache_key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        streams = []
+        for stream in self._get_content_streams(only, subtree=subtree):
+            latest_by = stream[0].model._meta.get_latest_by
+            if latest_by:
+                streams.append(stream + ('-' + latest_by,))
+        content = list(merge_content_streams(streams, None, limit=limit))
+        if cache_key:
+            cache.set(
+                cache_key,
+                (version, content),
+                app_settings.LATEST_CONTENT_CACHE_TTL
+            )
+        return content
+
+    def filter_subtree(self, queryset, field_name=None, include_self=True):
+        """
+        Filters the given queryset down to the rows that belong to the
+        section or any of its descendants, with a single query. If a field
+        name is given, the rows are those whose foreign key of that name
+        points into the subtree (e.g. articles); otherwise the queryset is
+        one of sections itself. How the subtree is selected depends on the
+        type of tree: a path prefix for materialized path trees, an lft/rgt
+        range for nested set trees, and a recursive common table expression
+        for adjacency list trees.
+        """
+        prefix = field_name and field_name + '__' or ''
+        if isinstance(self, MP_Node):
+            queryset = queryset.filter(**{
+                prefix + 'path__startswith': self.path
+            })
+            if not include_self:
+                queryset = queryset.filter(**{
+                    prefix + 'depth__gt': self.depth
+                })
+        elif isinstance(self, NS_Node):
+            lft_lookup = include_self and 'lft__gte' or 'lft__gt'
+            queryset = queryset.filter(**{
+                prefix + 'tree_id': self.tree_id,
+                prefix + lft_lookup: self.lft,
+                prefix + 'lft__lt': self.rgt,
+            })
+        elif isinstance(self, AL_Node):
+            qn = connections[queryset.db].ops.quote_name
+            opts = self.__class__._meta
+            if field_name:
+                column = queryset.model._meta.get_field(field_name).column
+            else:
+                column = queryset.model._meta.pk.column
+            column = "%s.%s" % (qn(queryset.model._meta.db_table), qn(column))
+            where = (
+                "%(column)s IN (WITH RECURSIVE subtree(id) AS ("
+                "SELECT %(pk)s FROM %(table)s WHERE %(pk)s = %%s "
+                "UNION ALL SELECT c.%(pk)s FROM %(table)s c "
+                "INNER JOIN subtree s ON c.%(parent)s = s.id"
+                ") SELECT id FROM subtree)"
+            ) % {
+                'column': column,
+                'pk': qn(opts.pk.column),
+                'table': qn(opts.db_table),
+                'parent': qn(opts.get_field('parent').column),
+            }
+            params = [self.pk]
+            if not include_self:
+                where += " AND %s <> %%s" % column
+                params.append(self.pk)
+            queryset = queryset.extra(where=[where], params=params)
+        return queryset
+
+    def _get_content_streams(self, only=[], subtree=False, include_self=True):
+        """
+        Returns a list of ``(queryset, relationship type)`` streams for the
+        content associated with the section, or with its whole subtree, to
+        be merged by merge_content_streams.
+        """
+        streams = []
+        content_type_ids = _get_content_type_ids(only)
+        for relation in get_content_relations(self):
+            if not relation.is_wanted(only, content_type_ids):
+                continue
+            if subtree:
+                fk_items = relation.get_subtree_items(
+                    self, content_type_ids, include_self
+                )
+            else:
+                fk_items = relation.get_items(self, content_type_ids)
+            if fk_items is None:
+                continue
+            if relation.is_generic:
+                for queryset in _get_generic_querysets(
+                    fk_items, relation.generic_fk):
+                    streams.append((queryset, relation.relationship_type))
+            else:
+                streams.append((fk_items, relation.relationship_type))
+        if len(only) == 0 or _get_label(self) in only:
+            if subtree:
+                subsections = self.filter_subtree(
+                    self.__class__.objects.all(), include_self=False
+                )
+            else:
+                subsections = self.get_children()
+            streams.append((subsections, 'subsection'))
+        return streams
+
 class SectionItem(models.Model):
     """A model of a generic relation between any item and a section"""
     section = models.ForeignKey('Section')
@@ -250,4 +763,20 @@ class SectionItem(models.Model):
         fk_app = self.content_object._meta.app_label
         fk_model = self.content_object.__class__.__name__
         fk_str = self.content_object.__unicode__()        
-        return u"%s.%s: %s" % (fk_app, fk_model, fk_str)
\ No newline at end of file
+        return u"%s.%s: %s" % (fk_app, fk_model, fk_str)
+
+def bump_section_data_version(sender, **kwargs):
+    """
+    Bumps the sections version (see scaffold.versions) whenever a section of
+    any model is saved, moved or removed.
+    """
+    if issubclass(sender, BaseSection):
+        bump_sections_version()
+
+post_save.connect(bump_section_data_version, dispatch_uid="sections-version")
+section_moved.connect(bump_section_data_version,
+    dispatch_uid="sections-version"
+)
+post_delete.connect(bump_section_data_version,
+    dispatch_uid="sections-version"
+)
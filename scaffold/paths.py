@@ -0,0 +1,315 @@
+"""
+Data structures used to resolve URL paths to sections without touching the
+database.
+"""
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+from django.core.urlresolvers import reverse
+try:
+    from threading import Lock
+except ImportError:
+    from dummy_threading import Lock
+
+# Key under which a trie node stores the value of the path ending at it. Path
+# segments are always non-empty strings, so this can never collide with one.
+_VALUE = None
+
+def split_path(path):
+    """
+    Splits a section path (or a request path) into its slug segments,
+    ignoring leading, trailing and repeated slashes.
+    """
+    return [segment for segment in path.split("/") if segment]
+
+class SectionPathIndex(object):
+    """
+    A segment trie over the full paths of all sections. Each node in the trie
+    is a dictionary keyed by slug; the node at the end of a section's path
+    holds whatever value was stored for that path (e.g. the section's primary
+    key).
+
+    Resolving a path costs O(depth of the path) regardless of the number of
+    sections in the tree. The index behaves like a (read-mostly) dictionary
+    keyed by full path, so it can be used wherever the old flat path map was.
+    """
+
+    # Timestamp at which the index was built from the database, if it was.
+    built_at = None
+
+    def __init__(self, paths=None):
+        self._root = {}
+        self._length = 0
+        if paths:
+            for path, value in paths.items():
+                self[path] = value
+
+    def _find_node(self, path):
+        node = self._root
+        for segment in split_path(path):
+            node = node.get(segment)
+            if node is None:
+                return None
+        return node
+
+    def __setitem__(self, path, value):
+        node = self._root
+        for segment in split_path(path):
+            node = node.setdefault(segment, {})
+        if _VALUE not in node:
+            self._length += 1
+        node[_VALUE] = value
+
+    def __getitem__(self, path):
+        node = self._find_node(path)
+        if node is None or _VALUE not in node:
+            raise KeyError(path)
+        return node[_VALUE]
+
+    def __delitem__(self, path):
+        segments = split_path(path)
+        trail = [self._root]
+        for segment in segments:
+            node = trail[-1].get(segment)
+            if node is None:
+                raise KeyError(path)
+            trail.append(node)
+        if _VALUE not in trail[-1]:
+            raise KeyError(path)
+        del trail[-1][_VALUE]
+        self._length -= 1
+        # Prune nodes which no longer lead to any value.
+        for depth in range(len(segments), 0, -1):
+            if trail[depth]:
+                break
+            del trail[depth - 1][segments[depth - 1]]
+
+    def __contains__(self, path):
+        node = self._find_node(path)
+        return node is not None and _VALUE in node
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def has_key(self, path):
+        return path in self
+
+    def get(self, path, default=None):
+        node = self._find_node(path)
+        if node is None:
+            return default
+        return node.get(_VALUE, default)
+
+    def items(self, path=None):
+        """
+        Returns a list of ``(full path, value)`` tuples for every path in the
+        index, parents before their children. If a path is given, only that
+        path and the paths below it are returned.
+        """
+        items = []
+        if path is None:
+            stack = [((), self._root)]
+        else:
+            node = self._find_node(path)
+            if node is None:
+                return items
+            stack = [(tuple(split_path(path)), node)]
+        while stack:
+            segments, node = stack.pop()
+            if _VALUE in node:
+                items.append(("/".join(segments), node[_VALUE]))
+            for segment in sorted(node, reverse=True):
+                if segment is not _VALUE:
+                    stack.append((segments + (segment,), node[segment]))
+        return items
+
+    def pop_subtree(self, path):
+        """
+        Removes the given path and every path below it from the index.
+        Returns the removed ``(full path, value)`` tuples.
+        """
+        items = self.items(path)
+        for item_path, value in reversed(items):
+            del self[item_path]
+        return items
+
+    def move_subtree(self, old_path, new_path):
+        """
+        Moves the given path and every path below it so that they sit under
+        ``new_path`` instead, e.g. when a section is moved or its slug is
+        changed. Returns the moved ``(full path, value)`` tuples, with their
+        new paths.
+        """
+        moved = []
+        old_depth = len(split_path(old_path))
+        new_segments = split_path(new_path)
+        for path, value in self.pop_subtree(old_path):
+            path = "/".join(new_segments + split_path(path)[old_depth:])
+            self[path] = value
+            moved.append((path, value))
+        return moved
+
+    def keys(self):
+        return [path for path, value in self.items()]
+
+    def values(self):
+        return [value for path, value in self.items()]
+
+    def match(self, path, nearest=False):
+        """
+        Finds the section path matching the given path. Returns a
+        ``(full path, value)`` tuple, or ``None`` if nothing matches.
+
+        By default only an exact match is returned. If ``nearest`` is True,
+        the deepest section whose path is a prefix of the given path is
+        returned instead, so a URL *under* a section (e.g.
+        ``news/2012/some-article``) resolves to that section (``news``).
+        """
+        node = self._root
+        matched = []
+        best = None
+        if _VALUE in node:
+            best = ("", node[_VALUE])
+        for segment in split_path(path):
+            node = node.get(segment)
+            if node is None:
+                break
+            matched.append(segment)
+            if _VALUE in node:
+                best = ("/".join(matched), node[_VALUE])
+        else:
+            # Every segment was consumed, so ``best`` is an exact match if
+            # the final node holds a value.
+            if _VALUE in node:
+                return best
+        if nearest:
+            return best
+        return None
+
+class PathMissCache(object):
+    """
+    A bounded, least-recently-used record of paths which are known not to
+    resolve to a section, so that repeated requests for them (404 probes,
+    bots, flatpages) can be rejected in constant time. Entries expire after
+    ``ttl`` seconds, and all of them are dropped when the tree version they
+    were recorded under changes.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _check_version(self, version):
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def contains(self, path, version):
+        """
+        Returns True if the path was recorded as a miss under the given tree
+        version, and hasn't expired since.
+        """
+        self._lock.acquire()
+        try:
+            self._check_version(version)
+            expires = self._entries.get(path)
+            if expires is None:
+                return False
+            # Re-insert the entry to mark it as the most recently used one.
+            del self._entries[path]
+            if expires < time.time():
+                return False
+            self._entries[path] = expires
+            return True
+        finally:
+            self._lock.release()
+
+    def add(self, path, version):
+        """Records the path as a miss under the given tree version."""
+        if self.max_size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            self._check_version(version)
+            if path in self._entries:
+                del self._entries[path]
+            elif len(self._entries) >= self.max_size:
+                del self._entries[iter(self._entries).next()]
+            self._entries[path] = time.time() + self.ttl
+        finally:
+            self._lock.release()
+
+def get_section_record(section, full_path=None):
+    """
+    Returns the compact record stored in the cache for the given section: a
+    ``(pk, title, slug, full path, depth)`` tuple.
+    """
+    if full_path is None:
+        full_path = section.full_path
+    return (
+        section.pk,
+        section.title,
+        section.slug,
+        full_path,
+        len(split_path(full_path))
+    )
+
+class LazySection(object):
+    """
+    A lightweight stand-in for a section, built from its cached record (see
+    ``get_section_record``). The pk, title, slug, full path and depth of the
+    section are available without a database query; accessing anything else
+    loads the real section from the database (once) and delegates to it.
+
+    A stand-in compares equal to the real section (either way round, as long
+    as the section model extends ``BaseSection``); otherwise, compare the pk
+    of the two.
+    """
+
+    def __init__(self, model, record):
+        self.pk, self.title, self.slug, self.full_path, self.depth = record
+        self._model = model
+        self._section = None
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the stand-in itself.
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.get_section(), name)
+
+    def __eq__(self, other):
+        return isinstance(other, (LazySection, self._model)) and \
+            other.pk == self.pk
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __unicode__(self):
+        return "-" * (self.depth - 1) + self.title
+
+    def __repr__(self):
+        return "<LazySection: %s>" % self.full_path
+
+    def get_section(self):
+        """Returns the real section, loading it if necessary."""
+        if self._section is None:
+            self._section = self._model.objects.get(pk=self.pk)
+        return self._section
+
+    def get_depth(self):
+        return self.depth
+
+    def get_absolute_url(self):
+        return reverse("section", kwargs={'section_path': self.full_path})
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent after a section (and with it, its descendants) is moved within the tree.
+# Treebeard moves nodes with bulk updates, so no post_save signal is sent for
+# any of the affected sections. ``old_path`` is the full path of the section
+# before the move.
+section_moved = Signal(providing_args=["instance", "old_path"])
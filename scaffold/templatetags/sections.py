@@ -1,10 +1,37 @@
+from hashlib import md5
+
 from django import template
+from django.core.cache import cache
+from django.template.loader import get_template
+from treebeard.mp_tree import MP_Node
+from treebeard.ns_tree import NS_Node
 
 from scaffold import app_settings
+from scaffold.paths import split_path
+from scaffold.versions import get_tree_version, get_sections_version
 Section = app_settings.get_extending_model()
 
 register = template.Library()
 
+def _is_descendant(section, ancestor):
+    """
+    Returns True if the section is the given ancestor or one of its 
+    descendants. This is answered from the materialized path or the nested 
+    set bounds already loaded on both sections, or else from the tree 
+    snapshot (see BaseSection.get_section_tree), rather than by querying.
+    """
+    if section.pk == ancestor.pk:
+        return True
+    if isinstance(section, MP_Node) and isinstance(ancestor, MP_Node):
+        return section.path.startswith(ancestor.path)
+    if isinstance(section, NS_Node) and isinstance(ancestor, NS_Node):
+        return section.tree_id == ancestor.tree_id and \
+            ancestor.lft < section.lft < ancestor.rgt
+    tree = Section.get_section_tree()
+    if section.pk in tree and ancestor.pk in tree:
+        return tree.is_descendant_of(section.pk, ancestor.pk)
+    return section.is_descendant_of(ancestor)
+
 class SectionNode(template.Node):
 
     def __init__(self, section=None, as_varname=None):
@@ -26,14 +53,31 @@ class SectionNode(template.Node):
             current_section = None
         return current_section
 
+    def _get_root_pk(self, section, root_sections):
+        """
+        Returns the pk of the root section that the given section is (or 
+        descends from), judging by the tree data already loaded on it: its 
+        materialized path, its nested set tree id or, failing those, the first 
+        slug of its full path.
+        """
+        if isinstance(section, MP_Node):
+            attr, value = 'path', section.path[:section.steplen]
+        elif isinstance(section, NS_Node):
+            attr, value = 'tree_id', section.tree_id
+        else:
+            attr, value = 'slug', (split_path(section.full_path) or [None])[0]
+        for root in root_sections:
+            if getattr(root, attr) == value:
+                return root.pk
+        return None
+
     def render(self, context):
-        root_sections = Section.get_root_nodes()
+        root_sections = Section.get_root_sections()
         current_section = self._resolve_section(context)     
         if current_section:
+            active_pk = self._get_root_pk(current_section, root_sections)
             for section in root_sections:
-                is_active = current_section.is_descendant_of(section) \
-                    or current_section.pk == section.pk
-                setattr(section, 'is_active', is_active)
+                setattr(section, 'is_active', section.pk == active_pk)
         context[self.as_varname] = root_sections
         return ''
 
@@ -74,6 +118,122 @@ def get_root_sections(parser, token):
         varname = tokens[4]
     return SectionNode(section=section, as_varname=varname)
 
+class SectionTreeNode(template.Node):
+
+    def __init__(self, root_var=None, depth_var=None, section_var=None,
+        template_var=None):
+        self.root_var = root_var
+        self.depth_var = depth_var
+        self.section_var = section_var
+        self.template_var = template_var
+
+    def _resolve(self, var, context, default=None):
+        if var is None:
+            return default
+        try:
+            return var.resolve(context)
+        except template.VariableDoesNotExist:
+            return default
+
+    def render(self, context):
+        root = self._resolve(self.root_var, context)
+        depth = self._resolve(self.depth_var, context)
+        section = self._resolve(self.section_var, context)
+        template_name = self._resolve(
+            self.template_var, context, 'scaffold/section_tree.html'
+        )
+        tree = Section.get_section_tree()
+        root_pk = root and root.pk
+        active_pk = section and section.pk
+        if root_pk is not None and root_pk not in tree:
+            return ''
+        if depth is not None:
+            depth = int(depth)
+        cache_key = None
+        if app_settings.NAVIGATION_CACHE_TTL:
+            active_path = None
+            if active_pk in tree:
+                active_path = tree.get_full_path(active_pk)
+            cache_key = "%s-navigation-%s" % (
+                app_settings.PATH_CACHE_KEY,
+                md5(repr((
+                    get_tree_version(),
+                    get_sections_version(),
+                    Section._meta.app_label + "." + Section._meta.object_name,
+                    root_pk,
+                    depth,
+                    active_path,
+                    template_name
+                ))).hexdigest()
+            )
+            html = cache.get(cache_key)
+            if html is not None:
+                return html
+        nodes = tree.get_navigation(root_pk, depth, active_pk)
+        if not nodes:
+            html = ''
+        else:
+            html = get_template(template_name).render(
+                template.Context({
+                    'nodes': nodes,
+                    'section_tree_template': template_name,
+                }, autoescape=context.autoescape)
+            )
+        if cache_key:
+            cache.set(cache_key, html, app_settings.NAVIGATION_CACHE_TTL)
+        return html
+
+@register.tag
+def section_tree(parser, token):
+    """
+    Renders the sections below a section (or all sections, if none is given)
+    as nested lists, down to the given number of levels. The section passed 
+    with 'with', and its ancestors, are marked as active.
+
+    Syntax::
+
+        {% section_tree [root] [depth [levels]] [with [section]] [using [template]] %}
+
+    Example usage::
+
+        {% section_tree depth 2 with section %}
+        {% section_tree rootsection depth 3 with section using "nav.html" %}
+
+    The whole tree is loaded with a single query (see 
+    BaseSection.get_section_tree), and the rendered HTML is cached until any 
+    section changes (see SCAFFOLD_NAVIGATION_CACHE_TTL). The template, 
+    'scaffold/section_tree.html' by default, renders a list of nodes, each of 
+    which has 'section', 'children', 'is_active' and 'is_ancestor' keys. It 
+    can render each node's children by including itself::
+
+        {% include section_tree_template with nodes=node.children %}
+    """
+    tokens = token.split_contents()
+    options = {}
+    bits = tokens[1:]
+    if bits and bits[0] not in ('depth', 'with', 'using'):
+        options['root'] = template.Variable(bits.pop(0))
+    if len(bits) % 2:
+        raise template.TemplateSyntaxError(
+            "Incorrect syntax for %r. Format is: {%% section_tree [root] "
+            "[depth [levels]] [with [section]] [using [template]] %%}" % 
+            tokens[0]
+        )
+    for option, value in zip(bits[::2], bits[1::2]):
+        if option not in ('depth', 'with', 'using') or option in options:
+            raise template.TemplateSyntaxError(
+                "Unknown or repeated option %r in %r tag." % (
+                    option, tokens[0]
+                )
+            )
+        options[option] = template.Variable(value)
+    return SectionTreeNode(
+        root_var=options.get('root'),
+        depth_var=options.get('depth'),
+        section_var=options.get('with'),
+        template_var=options.get('using')
+    )
+
 class SectionDescendantNode(template.Node):
     
     def __init__(self, section_var, ancestor_var, varname):
@@ -94,9 +254,7 @@ class SectionDescendantNode(template.Node):
         if not section or not ancestor:
             context[self.varname] = None
             return ''
-        result = section.is_descendant_of(ancestor) or \
-            section.pk == ancestor.pk
-        context[self.varname] = result
+        context[self.varname] = _is_descendant(section, ancestor)
         return ''
     
 @register.tag
@@ -109,10 +267,13 @@ def section_is_descendant(parser, token):
     Example usage::
 
         {% section_is_descendant mysubsection of rootsection as descends %}
+
+    A section counts as a descendant of itself. The check doesn't query the 
+    database; see mark_section_descendants to check a list of sections.
         
     """
     tokens = token.split_contents()
-    if tokens[2] != 'of' or tokens[4] != 'as' or len(tokens) != 6:
+    if len(tokens) != 6 or tokens[2] != 'of' or tokens[4] != 'as':
         raise template.TemplateSyntaxError((
             "Incorrect syntax for %r. Format is: {%% section_is_descendant "
             "[section] of [ancestor] as [varname]  %%}"
@@ -122,6 +283,45 @@ def section_is_descendant(parser, token):
     varname = tokens[5]
     return SectionDescendantNode(section_var, ancestor_var, varname)
 
+class SectionDescendantsNode(SectionDescendantNode):
+
+    def render(self, context):
+        sections, ancestor = self._resolve_vars(context)
+        sections = list(sections or [])
+        for section in sections:
+            is_descendant = bool(ancestor) and \
+                _is_descendant(section, ancestor)
+            setattr(section, 'is_descendant', is_descendant)
+        context[self.varname] = sections
+        return ''
+
+@register.tag
+def mark_section_descendants(parser, token):
+    """
+    Checks a whole list of sections against one ancestor, setting an 
+    'is_descendant' attribute on each of them, without querying the 
+    database (see section_is_descendant).
+
+    Syntax::
+
+        {% mark_section_descendants [sections] of [ancestor] as [varname] %}
+
+    Example usage::
+
+        {% mark_section_descendants subsections of section as subsections %}
+        {% for subsection in subsections %}
+            {% if subsection.is_descendant %}...{% endif %}
+        {% endfor %}
+        
+    """
+    tokens = token.split_contents()
+    if len(tokens) != 6 or tokens[2] != 'of' or tokens[4] != 'as':
+        raise template.TemplateSyntaxError((
+            "Incorrect syntax for %r. Format is: {%% mark_section_descendants "
+            "[sections] of [ancestor] as [varname]  %%}"
+        ) % tokens[0])
+    return SectionDescendantsNode(tokens[1], tokens[3], tokens[5])
+
 @register.inclusion_tag('scaffold/admin/submit_line.html', takes_context=True)
 def submit_row(context):
     """
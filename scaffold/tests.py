@@ -5,12 +5,18 @@ except ImportError:
     from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
 from django.contrib.auth.models import User
+from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.db import models
 from django.db.models.loading import cache
 from django.template import Context, Template
 from django.test import TestCase
+from django.test.client import RequestFactory
+
+from treebeard.al_tree import AL_Node
+from treebeard.ns_tree import NS_Node
 
 from models import BaseSection
 
@@ -90,6 +96,73 @@ class SortedTestArticle(BaseSortedTestArticle):
 class OtherSortedTestArticle(BaseSortedTestArticle):
     pass
 
+class TestSectionItem(models.Model):
+    """A mock generic relation between any item and a section"""
+    section = models.ForeignKey(TestSection)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey()
+
+class TestNewsItem(models.Model):
+    """A mock dated object, attached to sections through TestSectionItem"""
+    title = models.CharField(max_length=255)
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        get_latest_by = 'pub_date'
+
+class TestEvent(models.Model):
+    """A mock dated object, attached to sections through TestSectionItem"""
+    title = models.CharField(max_length=255)
+    date = models.DateField(null=True)
+
+    class Meta:
+        get_latest_by = 'date'
+
+class TestNSSection(NS_Node):
+    """
+    A mock nested set section. Sections always use the treebeard node type
+    configured in the settings, so the BaseSection methods with code paths
+    for other node types are borrowed to test those.
+    """
+    slug = models.SlugField()
+    title = models.CharField(max_length=255)
+    order = models.IntegerField(default=0)
+
+    get_tree_rows = classmethod(BaseSection.get_tree_rows.im_func)
+    get_content_counts_for = classmethod(
+        BaseSection.get_content_counts_for.im_func
+    )
+    filter_subtree = BaseSection.filter_subtree.im_func
+
+class TestALSection(AL_Node):
+    """A mock adjacency list section (see TestNSSection)"""
+    parent = models.ForeignKey('self', related_name='children_set',
+        null=True, db_index=True)
+    sib_order = models.PositiveIntegerField()
+    slug = models.SlugField()
+    title = models.CharField(max_length=255)
+    order = models.IntegerField(default=0)
+
+    get_tree_rows = classmethod(BaseSection.get_tree_rows.im_func)
+    get_content_counts_for = classmethod(
+        BaseSection.get_content_counts_for.im_func
+    )
+    filter_subtree = BaseSection.filter_subtree.im_func
+
+def _get_tree_data(data):
+    """Strips BASE_DATA down to the fields of the mock NS and AL sections."""
+    tree_data = []
+    for node in data:
+        tree_node = {'data': {
+            'slug': node['data']['slug'],
+            'title': node['data']['title'],
+        }}
+        if 'children' in node:
+            tree_node['children'] = _get_tree_data(node['children'])
+        tree_data.append(tree_node)
+    return tree_data
+
 class SectionTest(TestCase):
 
     csrf_disabled = False
@@ -103,8 +176,8 @@ class SectionTest(TestCase):
         def get_test_model():
             return TestSection
         app_settings.get_extending_model = get_test_model
-        from middleware import _build_section_path_map
-        _build_section_path_map()
+        from middleware import reset_section_path_map
+        reset_section_path_map(TestSection)
 
     def _disable_csrf_middleware(self):
         settings.MIDDLEWARE_CLASSES = filter(lambda m: 'CsrfMiddleware' \
@@ -398,6 +471,105 @@ class SectionTest(TestCase):
              [u'A', u'C', u'D', u'J', u'Y', u'Z']
          )
 
+    def test_model_get_related_content_generic(self):
+        """
+        Test that get_related_content fetches content attached through
+        generic relations with one query per content type.
+        """
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='2')
+        other_section = TestSection.objects.get(slug='1')
+        articles = []
+        for title in ['A', 'B', 'C']:
+            article = SortedTestArticle(title=title, section=other_section)
+            article.save()
+            articles.append(article)
+        for obj in articles + list(TestSection.objects.filter(depth=1)):
+            TestSectionItem(section=section, content_object=obj).save()
+        ContentType.objects.clear_cache()
+        # One query for each of the four relations, then one to look up and
+        # one to fetch each of the two content types.
+        with self.assertNumQueries(8):
+            content = section.get_related_content()
+        generic_content = [
+            c for c in content if c[3] == 'generic-foreign-key'
+        ]
+        self.assertEqual(len(generic_content), 7)
+        self.assertEqual(
+            sorted([c[0].title for c in generic_content]),
+            ['1', '2', '3', '4', 'A', 'B', 'C']
+        )
+        # Items pointing to deleted objects are skipped.
+        articles[0].delete()
+        self.assertEqual(len(section.get_related_content()), 6)
+        # Only the articles' own relation and the generic items pointing to
+        # articles are fetched; other relations aren't queried at all.
+        with self.assertNumQueries(3):
+            content = section.get_related_content(
+                only=['scaffold.SortedTestArticle']
+            )
+        self.assertEqual([c[0].title for c in content], ['C', 'B'])
+        with self.assertNumQueries(0):
+            content = section.get_associated_content(only=['foo.Bar'])
+        self.assertEqual(content, [])
+
+    def test_model_get_tree_rows_node_types(self):
+        """
+        Test that get_tree_rows lists nested set and adjacency list trees
+        like materialized path ones.
+        """
+        TestSection.load_bulk(BASE_DATA)
+        expected = [
+            (depth, slug) for pk, parent, depth, slug
+            in TestSection.get_tree_rows('slug')
+        ]
+        for model in (TestNSSection, TestALSection):
+            model.load_bulk(_get_tree_data(BASE_DATA))
+            with self.assertNumQueries(1):
+                rows = model.get_tree_rows('slug')
+            self.assertEqual(
+                [(depth, slug) for pk, parent, depth, slug in rows], expected
+            )
+            for pk, parent, depth, slug in rows:
+                node_parent = model.objects.get(pk=pk).get_parent()
+                self.assertEqual(parent, node_parent and node_parent.pk)
+
+    def test_model_filter_subtree_node_types(self):
+        """
+        Test that filter_subtree works with nested set and adjacency list
+        trees.
+        """
+        for model in (TestNSSection, TestALSection):
+            model.load_bulk(_get_tree_data(BASE_DATA))
+            section = model.objects.get(slug='2')
+            self.assertEqual(
+                sorted(s.slug for s in section.filter_subtree(
+                    model.objects.all()
+                )),
+                ['2', '21', '22', '23', '231', '24']
+            )
+            self.assertEqual(
+                sorted(s.slug for s in section.filter_subtree(
+                    model.objects.all(), include_self=False
+                )),
+                ['21', '22', '23', '231', '24']
+            )
+            self.assertEqual(
+                [s.slug for s in model.objects.get(slug='231').filter_subtree(
+                    model.objects.all()
+                )],
+                ['231']
+            )
+        # Rows pointing into the subtree, here the sections whose parent is
+        # in it.
+        section = TestALSection.objects.get(slug='2')
+        self.assertEqual(
+            sorted(s.slug for s in section.filter_subtree(
+                TestALSection.objects.all(), 'parent'
+            )),
+            ['21', '22', '23', '231', '24']
+        )
+
     def test_model_get_associated_content(self):
         """Test the BaseSection model's get_associated_content method"""
         TestSection.load_bulk(BASE_DATA)
@@ -424,6 +596,321 @@ class SectionTest(TestCase):
             [u'1 Test Article', u'21', u'22', u'23', u'24']
         )
 
+    def test_model_get_associated_content_order(self):
+        """
+        Test that get_associated_content keeps its order when no sort key is
+        given.
+        """
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='2')
+        for title in ['b', 'a', 'c']:
+            TestArticle(title=title, section=section).save()
+        for title in ['x', 'y']:
+            SortedTestArticle(title=title, section=section).save()
+        content = section.get_associated_content()
+        self.assertEqual(
+            [c[0].title for c in content],
+            [u'24', u'23', u'22', u'21', u'b', u'a', u'c', u'x', u'y']
+        )
+        content = section.get_associated_content(
+            only=['scaffold.TestArticle']
+        )
+        self.assertEqual([c[0].title for c in content], [u'b', u'a', u'c'])
+
+    def test_model_iter_associated_content(self):
+        """Test the BaseSection model's iter_associated_content method"""
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='2')
+        for title in ['Z', '3', 'A']:
+            TestArticle(title=title, section=section).save()
+        for title in ['B', '25']:
+            SortedTestArticle(title=title, section=section).save()
+        TestSectionItem(
+            section=section,
+            content_object=TestSection.objects.get(slug='1')
+        ).save()
+        content = list(section.iter_associated_content('title'))
+        self.assertEqual(
+            [c[0].title for c in content],
+            [u'1', u'21', u'22', u'23', u'24', u'25', u'3', u'A', u'B', u'Z']
+        )
+        self.assertEqual(
+            [c[3] for c in content[:2]],
+            ['generic-foreign-key', 'subsection']
+        )
+        self.assertEqual(
+            [c[0].title for c in section.iter_associated_content('-title')],
+            [c[0].title for c in reversed(content)]
+        )
+        # A page costs one query per relation (and per content type of the
+        # generic relation), plus one to find and one to look up that type.
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(7):
+            page = list(section.iter_associated_content(
+                'title', offset=4, limit=3
+            ))
+        self.assertEqual([c[0].title for c in page], [u'24', u'25', u'3'])
+        page = section.iter_associated_content(
+            'title', only=['scaffold.TestArticle'], offset=1
+        )
+        self.assertEqual([c[0].title for c in page], [u'A', u'Z'])
+
+    def test_model_get_content_counts_node_types(self):
+        """
+        Test that get_content_counts_for counts the subsections of nested
+        set and adjacency list sections with a single query.
+        """
+        for model in (TestNSSection, TestALSection):
+            model.load_bulk(_get_tree_data(BASE_DATA))
+            sections = list(model.objects.all())
+            label = 'scaffold.%s' % model._meta.object_name
+            with self.assertNumQueries(1):
+                counts = model.get_content_counts_for(sections)
+            self.assertEqual(
+                dict((s.slug, counts[s.pk].get(label, 0)) for s in sections),
+                {'1': 0, '2': 4, '21': 0, '22': 0, '23': 1, '231': 0,
+                 '24': 0, '3': 0, '4': 1, '41': 0}
+            )
+
+    def test_model_get_subtree_content(self):
+        """Test the BaseSection model's get_subtree_content method"""
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='2')
+        for slug, title in [('2', 'C'), ('23', 'A'), ('231', 'E'), ('3', 'B')]:
+            TestArticle(
+                title=title,
+                section=TestSection.objects.get(slug=slug)
+            ).save()
+        article = SortedTestArticle(title='D', section=section)
+        article.save()
+        TestSectionItem(
+            section=TestSection.objects.get(slug='231'),
+            content_object=article
+        ).save()
+        content = section.get_subtree_content('title')
+        self.assertEqual(
+            [c[0].title for c in content],
+            [u'21', u'22', u'23', u'231', u'24', u'A', u'C', u'D', u'E']
+        )
+        content = section.get_subtree_content(
+            '-title', only=['scaffold.TestArticle'], limit=2
+        )
+        self.assertEqual([c[0].title for c in content], [u'E', u'C'])
+        content = TestSection.objects.get(slug='23').get_subtree_content(
+            'title', include_self=False
+        )
+        self.assertEqual(
+            [(c[0].title, c[3]) for c in content],
+            [(u'231', 'subsection'), (u'D', 'generic-foreign-key'),
+             (u'E', 'foreign-key')]
+        )
+
+    def test_content_merge_null_sort_values(self):
+        """
+        Test that objects with a NULL sort value are merged after all others,
+        whichever way the content is sorted.
+        """
+        from datetime import date, datetime
+        from content import merge_content_streams
+        for title, day in [('A', 3), ('B', None), ('C', 1), ('D', None)]:
+            TestEvent(title=title, date=day and date(2012, 1, day)).save()
+        TestNewsItem(title='E', pub_date=datetime(2012, 1, 2)).save()
+        streams = [
+            (TestEvent.objects.all(), 'generic-foreign-key'),
+            (TestNewsItem.objects.all(), 'generic-foreign-key', 'pub_date'),
+        ]
+        content = merge_content_streams(streams, 'date')
+        self.assertEqual(
+            [c[0].title for c in content], ['C', 'E', 'A', 'B', 'D']
+        )
+        streams[1] = streams[1][:2] + ('-pub_date',)
+        content = merge_content_streams(streams, '-date', limit=4)
+        self.assertEqual(
+            [c[0].title for c in content], ['A', 'E', 'C', 'B']
+        )
+
+    def test_model_get_latest_content(self):
+        """Test the BaseSection model's get_latest_content method"""
+        from datetime import date, datetime
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='2')
+        subsection = TestSection.objects.get(slug='23')
+        TestArticle(title='Undated', section=section).save()
+        for title, day, target in [
+            ('A', 1, section), ('B', 5, subsection), ('C', 3, section)]:
+            news_item = TestNewsItem(
+                title=title,
+                pub_date=datetime(2012, 1, day, 12)
+            )
+            news_item.save()
+            TestSectionItem(section=target, content_object=news_item).save()
+        for title, day in [('D', 2), ('E', 6)]:
+            event = TestEvent(title=title, date=date(2012, 1, day))
+            event.save()
+            TestSectionItem(section=subsection, content_object=event).save()
+        content = section.get_latest_content(limit=3)
+        self.assertEqual([c[0].title for c in content], ['E', 'B', 'C'])
+        self.assertEqual(content[0].sort_key, date(2012, 1, 6))
+        content = section.get_latest_content(limit=3, subtree=False)
+        self.assertEqual([c[0].title for c in content], ['C', 'A'])
+        content = section.get_latest_content(only=['scaffold.TestEvent'])
+        self.assertEqual([c[0].title for c in content], ['E', 'D'])
+        ttl = app_settings.LATEST_CONTENT_CACHE_TTL
+        app_settings.LATEST_CONTENT_CACHE_TTL = 60
+        try:
+            content = section.get_latest_content(limit=3)
+            with self.assertNumQueries(0):
+                self.assertEqual(section.get_latest_content(limit=3), content)
+            # Changing the tree invalidates cached feeds.
+            from versions import bump_tree_version
+            bump_tree_version()
+            # One query to find the generic content types, then one for each
+            # dated type; relations to undated models aren't queried.
+            with self.assertNumQueries(3):
+                section.get_latest_content(limit=3)
+        finally:
+            app_settings.LATEST_CONTENT_CACHE_TTL = ttl
+
+    def test_model_get_content_counts(self):
+        """Test the BaseSection model's get_content_counts methods"""
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='2')
+        for title in ['A', 'B']:
+            TestArticle(title=title, section=section).save()
+        article = SortedTestArticle(title='C', section=section)
+        article.save()
+        for obj in [article] + list(TestSection.objects.filter(depth=1)[:2]):
+            TestSectionItem(section=section, content_object=obj).save()
+        section.get_content_counts()
+        # One query per relation; the subsections are counted by treebeard.
+        with self.assertNumQueries(4):
+            counts = section.get_content_counts()
+        self.assertEqual(counts, {
+            'scaffold.TestArticle': 2,
+            'scaffold.SortedTestArticle': 2,
+            'scaffold.TestSection': 6,
+        })
+        self.assertEqual(
+            section.get_content_counts(only=['scaffold.SortedTestArticle']),
+            {'scaffold.SortedTestArticle': 2}
+        )
+        subsections = list(section.get_subsections())
+        TestArticle(title='D', section=subsections[0]).save()
+        with self.assertNumQueries(4):
+            counts = TestSection.get_content_counts_for(subsections)
+        self.assertEqual(counts, {
+            subsections[0].pk: {'scaffold.TestArticle': 1},
+            subsections[1].pk: {},
+            subsections[2].pk: {'scaffold.TestSection': 1},
+            subsections[3].pk: {},
+        })
+
+    def test_content_run_in_parallel(self):
+        """Test the thread pool used to query relations at the same time"""
+        import content
+        import threading
+        import time
+        active = []
+        peak = []
+        lock = threading.Lock()
+        def job(value):
+            def run():
+                with lock:
+                    active.append(value)
+                    peak.append(len(active))
+                time.sleep(0.01)
+                with lock:
+                    active.remove(value)
+                if value == 3:
+                    raise ValueError(value)
+                return value * 2
+            return run
+        can_query_in_parallel = content._can_query_in_parallel
+        content._can_query_in_parallel = lambda using: True
+        try:
+            self.assertEqual(
+                content.run_in_parallel([job(v) for v in [0, 1, 2, 4]], 2),
+                [0, 2, 4, 8]
+            )
+            self.assertEqual(max(peak), 2)
+            self.assertRaises(
+                ValueError,
+                content.run_in_parallel, [job(v) for v in range(5)], 3
+            )
+        finally:
+            content._can_query_in_parallel = can_query_in_parallel
+        # SQLite connections can't share the test database, so relations are
+        # queried one after another, with the same results.
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='2')
+        for title in ['B', 'A']:
+            TestArticle(title=title, section=section).save()
+            SortedTestArticle(title=title, section=section).save()
+        expected = section.get_related_content(infer_sort=True)
+        workers = app_settings.PARALLEL_CONTENT_QUERIES
+        app_settings.PARALLEL_CONTENT_QUERIES = 4
+        try:
+            self.assertEqual(
+                section.get_related_content(infer_sort=True),
+                expected
+            )
+        finally:
+            app_settings.PARALLEL_CONTENT_QUERIES = workers
+
+    def test_content_item(self):
+        """
+        Test that associated content is returned as immutable rows, and that
+        the content objects themselves aren't modified.
+        """
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='2')
+        TestArticle(title='1 Test Article', section=section).save()
+        content = section.get_associated_content(sort_key='title')
+        item = content[0]
+        obj, app, model, rel = item
+        self.assertEqual(obj.title, '1 Test Article')
+        self.assertEqual(item, (obj, 'scaffold', 'TestArticle', 'foreign-key'))
+        self.assertEqual(item.content_type, 'scaffold.TestArticle')
+        self.assertEqual(item.sort_key, '1 Test Article')
+        self.assertEqual(content[1].relationship_type, 'subsection')
+        self.assertFalse(hasattr(obj, 'content_type'))
+        self.assertFalse(hasattr(obj, '_associated_content_tmp_sort_key'))
+        self.assertRaises(AttributeError, setattr, item, 'sort_key', None)
+        template = Template(
+            "{% for obj, app, model, rel in content %}{{ model }} {% endfor %}"
+        )
+        self.assertEqual(
+            template.render(Context({'content': content[:2]})),
+            "TestArticle TestSection "
+        )
+
+    def test_content_relations(self):
+        """Test the classification of the relations pointing at sections"""
+        from content import get_content_relations
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='1')
+        self.assertTrue(
+            get_content_relations(section) is \
+            get_content_relations(TestSection)
+        )
+        relations = dict([
+            (relation.label, relation)
+            for relation in get_content_relations(TestSection)
+        ])
+        article = relations['scaffold.SortedTestArticle']
+        self.assertEqual(article.accessor_name, 'sortedtestarticle_set')
+        self.assertFalse(article.is_generic)
+        self.assertEqual(article.relationship_type, 'foreign-key')
+        self.assertEqual(article.ordering, ['title'])
+        item = relations['scaffold.TestSectionItem']
+        self.assertTrue(item.is_generic)
+        self.assertEqual(item.generic_fk.name, 'content_object')
+        self.assertEqual(item.relationship_type, 'generic-foreign-key')
+        self.assertTrue(article.is_wanted([], []))
+        self.assertFalse(article.is_wanted(['scaffold.TestArticle'], [1]))
+        self.assertTrue(item.is_wanted(['scaffold.TestArticle'], [1]))
+        self.assertFalse(item.is_wanted(['foo.Bar'], []))
+
     def test_model_get_subsections(self):
         """Test the BaseSection model's get_subsections method"""
         TestSection.load_bulk(BASE_DATA)
@@ -445,6 +932,595 @@ class SectionTest(TestCase):
             '23'
         )
 
+    def test_model_get_inherited_fields(self):
+        """Test the BaseSection model's get_inherited_fields method"""
+        TestSection.load_bulk(BASE_DATA)
+        section = TestSection.objects.get(slug='231')
+        section.description = ''
+        section.save()
+        TestSection.objects.filter(slug='23').update(description='', order=5)
+        section = TestSection.objects.get(slug='231')
+        # The ancestors are fetched with a single query.
+        with self.assertNumQueries(1):
+            values = section.get_inherited_fields('description', 'order')
+        self.assertEqual(values, {'description': '2', 'order': 5})
+        ttl = app_settings.INHERITED_FIELDS_CACHE_TTL
+        app_settings.INHERITED_FIELDS_CACHE_TTL = 60
+        try:
+            section.get_inherited_fields('description')
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    section.get_first_populated_field('description'), '2'
+                )
+            # Saving any section invalidates the cached values.
+            parent = TestSection.objects.get(slug='23')
+            parent.description = '23'
+            parent.save()
+            self.assertEqual(
+                section.get_first_populated_field('description'), '23'
+            )
+        finally:
+            app_settings.INHERITED_FIELDS_CACHE_TTL = ttl
+
+    def test_model_get_path_records(self):
+        """Test the BaseSection model's get_path_records method"""
+        TestSection.load_bulk(BASE_DATA)
+        with self.assertNumQueries(1):
+            records = TestSection.get_path_records()
+        self.assertEqual(len(records), TestSection.objects.count())
+        for pk, title, slug, full_path, depth in records:
+            section = TestSection.objects.get(pk=pk)
+            self.assertEqual(full_path, section.full_path)
+            self.assertEqual(depth, section.get_depth())
+        self.assertEqual(
+            [r[2] for r in records],
+            ['1', '2', '21', '22', '23', '231', '24', '3', '4', '41']
+        )
+
+    def test_section_tree(self):
+        """Test the in-memory tree snapshot"""
+        TestSection.load_bulk(BASE_DATA)
+        pks = dict([(s.slug, s.pk) for s in TestSection.objects.all()])
+        with self.assertNumQueries(1):
+            tree = TestSection.get_section_tree()
+        with self.assertNumQueries(0):
+            self.assertTrue(TestSection.get_section_tree() is tree)
+            self.assertEqual(len(tree), 10)
+            self.assertEqual(
+                tree.get_roots(),
+                [pks['1'], pks['2'], pks['3'], pks['4']]
+            )
+            self.assertEqual(
+                tree.get_children(pks['2']),
+                [pks['21'], pks['22'], pks['23'], pks['24']]
+            )
+            self.assertEqual(tree.get_children(pks['231']), [])
+            self.assertEqual(
+                tree.get_descendants(pks['23']), [pks['231']]
+            )
+            self.assertEqual(
+                tree.get_ancestors(pks['231']), [pks['2'], pks['23']]
+            )
+            self.assertEqual(tree.get_parent(pks['2']), None)
+            self.assertEqual(tree.get_full_path(pks['231']), '2/23/231')
+            self.assertTrue(tree.is_descendant_of(pks['231'], pks['2']))
+            self.assertFalse(tree.is_descendant_of(pks['2'], pks['2']))
+            self.assertFalse(tree.is_descendant_of(pks['41'], pks['2']))
+            self.assertEqual(tree.get_section(pks['23']).title, '23')
+        section = TestSection.objects.get(slug='231')
+        self.assertEqual(section.type, 'subsection')
+        self.assertEqual(TestSection.objects.get(slug='2').type, 'section')
+        use_tree = app_settings.USE_SECTION_TREE
+        app_settings.USE_SECTION_TREE = True
+        try:
+            parent = TestSection.objects.get(slug='23')
+            root = TestSection.objects.get(slug='2')
+            with self.assertNumQueries(0):
+                self.assertEqual(section.full_path, '2/23/231')
+                self.assertTrue(section.is_descendant_of(parent))
+                self.assertEqual(section.type, 'subsection')
+                self.assertEqual(root.type, 'section')
+            # Changing any section replaces the snapshot.
+            parent.slug = 'twenty-three'
+            parent.save()
+            self.assertFalse(TestSection.get_section_tree() is tree)
+            self.assertEqual(section.full_path, '2/twenty-three/231')
+            # ...but changing sections doesn't rebuild it along the way.
+            from tree import SectionTree
+            build = SectionTree.build
+            builds = []
+            def count_builds(cls, model):
+                builds.append(model)
+                return build.im_func(cls, model)
+            SectionTree.build = classmethod(count_builds)
+            try:
+                defer_updates = app_settings.DEFER_PATH_MAP_UPDATES
+                app_settings.DEFER_PATH_MAP_UPDATES = False
+                try:
+                    child = parent.add_child(slug='232', title='232')
+                    child.slug = '233'
+                    child.save()
+                    child.move(TestSection.objects.get(slug='4'), 'last-child')
+                    child.delete()
+                finally:
+                    app_settings.DEFER_PATH_MAP_UPDATES = defer_updates
+                self.assertEqual(builds, [])
+                self.assertEqual(section.full_path, '2/twenty-three/231')
+                self.assertEqual(builds, [TestSection])
+            finally:
+                SectionTree.build = build
+        finally:
+            app_settings.USE_SECTION_TREE = use_tree
+
+    def test_shared_section_tree(self):
+        """Test sharing serialized tree snapshots between processes"""
+        import os
+        import shutil
+        import tempfile
+        import tree as tree_module
+        TestSection.load_bulk(BASE_DATA)
+        pks = dict([(s.slug, s.pk) for s in TestSection.objects.all()])
+        tree = TestSection.get_section_tree()
+        loaded = tree_module.SectionTree.from_bytes(
+            TestSection, tree.to_bytes()
+        )
+        self.assertEqual(len(loaded), 10)
+        for pk in pks.values():
+            self.assertEqual(loaded.get_record(pk), tree.get_record(pk))
+            self.assertEqual(loaded.get_children(pk), tree.get_children(pk))
+            self.assertEqual(
+                loaded.get_descendants(pk), tree.get_descendants(pk)
+            )
+        self.assertEqual(loaded.get_roots(), tree.get_roots())
+        self.assertFalse(max(pks.values()) + 1 in loaded)
+        storage = app_settings.SECTION_TREE_STORAGE
+        directory = app_settings.SECTION_TREE_DIR
+        app_settings.SECTION_TREE_DIR = tempfile.mkdtemp()
+        try:
+            for app_settings.SECTION_TREE_STORAGE in ('cache', 'file'):
+                # The first process publishes the snapshot...
+                tree_module._trees.clear()
+                with self.assertNumQueries(1):
+                    tree = TestSection.get_section_tree()
+                # ...which the others load without touching the database.
+                tree_module._trees.clear()
+                with self.assertNumQueries(0):
+                    loaded = TestSection.get_section_tree()
+                    self.assertFalse(loaded is tree)
+                    self.assertEqual(
+                        loaded.get_full_path(pks['231']), '2/23/231'
+                    )
+                    self.assertTrue(
+                        loaded.is_descendant_of(pks['231'], pks['2'])
+                    )
+            section = TestSection.objects.get(slug='23')
+            section.title = 'Twenty-three'
+            section.save()
+            tree = TestSection.get_section_tree()
+            self.assertEqual(tree.get_record(pks['23'])[1], 'Twenty-three')
+            # The outdated file was removed once it was replaced.
+            self.assertEqual(len(os.listdir(app_settings.SECTION_TREE_DIR)), 1)
+            # If another process removes the file between checking for it and
+            # opening it, the tree is built instead.
+            exists = os.path.exists
+            def remove_file(path):
+                if exists(path):
+                    os.remove(path)
+                return True
+            tree_module._trees.clear()
+            os.path.exists = remove_file
+            try:
+                tree = TestSection.get_section_tree()
+            finally:
+                os.path.exists = exists
+            self.assertEqual(tree.get_record(pks['23'])[1], 'Twenty-three')
+            self.assertEqual(getattr(tree, 'path', None), None)
+        finally:
+            shutil.rmtree(app_settings.SECTION_TREE_DIR)
+            app_settings.SECTION_TREE_STORAGE = storage
+            app_settings.SECTION_TREE_DIR = directory
+            tree_module._trees.clear()
+
+    def test_path_index(self):
+        """Test the segment trie used to resolve paths to sections."""
+        from paths import SectionPathIndex
+        index = SectionPathIndex({'2': 'a', '2/23': 'b', '2/23/231': 'c'})
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index['2/23'], 'b')
+        self.assertEqual(index.match('/2/23/'), ('2/23', 'b'))
+        self.assertEqual(index.match('2/24'), None)
+        self.assertEqual(index.match('2/23/x/y', nearest=True), ('2/23', 'b'))
+        self.assertEqual(index.match('5/23', nearest=True), None)
+        del index['2/23']
+        self.assertFalse('2/23' in index)
+        self.assertEqual(index['2/23/231'], 'c')
+        self.assertEqual(index.match('2/23/x', nearest=True), ('2', 'a'))
+        del index['2/23/231']
+        self.assertEqual(index.keys(), ['2'])
+
+    def test_middleware_lookup_section(self):
+        """Test resolving sections from requests."""
+        from middleware import lookup_section
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        factory = RequestFactory()
+        section = lookup_section(factory.get('/2/23/231/'))
+        self.assertEqual(section.slug, '231')
+        self.assertEqual(lookup_section(factory.get('/2/23/foo/')), None)
+        section = lookup_section(factory.get('/2/23/foo/'), nearest=True)
+        self.assertEqual(section.slug, '23')
+        self.assertEqual(lookup_section(factory.get('/foo/')), None)
+
+    def test_middleware_path_map_maintenance(self):
+        """Test incremental updates of the path map as sections change."""
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        # Tests run inside a transaction, which would defer all updates.
+        defer_updates = app_settings.DEFER_PATH_MAP_UPDATES
+        app_settings.DEFER_PATH_MAP_UPDATES = False
+        try:
+            self._check_path_map_maintenance()
+        finally:
+            app_settings.DEFER_PATH_MAP_UPDATES = defer_updates
+
+    def _check_path_map_maintenance(self):
+        from middleware import _get_section_path_map
+        from versions import get_tree_version
+        version = get_tree_version()
+        # Changing the title doesn't touch the map.
+        section = TestSection.objects.get(slug='23')
+        section.title = 'Twenty Three'
+        section.save()
+        self.assertEqual(get_tree_version(), version)
+        # Changing the slug moves the section's subtree.
+        section.slug = '2x'
+        section.save()
+        self.assertNotEqual(get_tree_version(), version)
+        paths = _get_section_path_map()
+        self.assertFalse('2/23' in paths)
+        self.assertEqual(paths['2/2x'], section.pk)
+        self.assertEqual(
+            paths['2/2x/231'], TestSection.objects.get(slug='231').pk
+        )
+        # Moving the section does too.
+        version = get_tree_version()
+        section.move(TestSection.objects.get(slug='4'), 'first-child')
+        self.assertNotEqual(get_tree_version(), version)
+        paths = _get_section_path_map()
+        self.assertFalse('2/2x' in paths)
+        self.assertEqual(
+            paths['4/2x/231'], TestSection.objects.get(slug='231').pk
+        )
+        self.assertEqual(paths['4/2x'], section.pk)
+        # New sections are added, deleted ones are removed.
+        TestSection.objects.get(slug='4').add_child(slug='42', title='42')
+        self.assertTrue('4/42' in _get_section_path_map())
+        TestSection.objects.get(slug='2x').delete()
+        paths = _get_section_path_map()
+        self.assertFalse('4/2x' in paths)
+        self.assertFalse('4/2x/231' in paths)
+        self.assertEqual(
+            sorted(paths.keys()),
+            sorted(r[3] for r in TestSection.get_path_records())
+        )
+        # While another process holds the lock on the map, a change drops
+        # the map rather than risk overwriting a concurrent update.
+        from django.core.cache import cache
+        from middleware import _get_path_map_lock_key
+        version = get_tree_version()
+        cache.add(_get_path_map_lock_key(), True)
+        try:
+            section = TestSection.objects.get(slug='42')
+            section.slug = '43'
+            section.save()
+            self.assertEqual(cache.get(app_settings.PATH_CACHE_KEY), None)
+            self.assertNotEqual(get_tree_version(), version)
+        finally:
+            cache.delete(_get_path_map_lock_key())
+        paths = _get_section_path_map()
+        self.assertTrue('4/43' in paths)
+        self.assertFalse('4/42' in paths)
+
+    def test_middleware_deferred_path_map_updates(self):
+        """Test that path map updates are deferred and coalesced."""
+        from middleware import _get_section_path_map, \
+            batch_section_changes, flush_section_changes
+        from versions import get_tree_version
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        defer_updates = app_settings.DEFER_PATH_MAP_UPDATES
+        app_settings.DEFER_PATH_MAP_UPDATES = True
+        try:
+            version = get_tree_version()
+            built_at = _get_section_path_map().built_at
+            # Changes which don't affect paths are never deferred.
+            section = TestSection.objects.get(slug='24')
+            section.title = 'Twenty Four'
+            section.save()
+            with self.assertNumQueries(0):
+                flush_section_changes()
+            self.assertEqual(get_tree_version(), version)
+            # Changes made in a transaction are applied once it's flushed...
+            for slug in ('21', '22'):
+                section = TestSection.objects.get(slug=slug)
+                section.slug = slug + 'b'
+                section.save()
+            TestSection.objects.get(slug='23').move(
+                TestSection.objects.get(slug='4'), 'last-child'
+            )
+            TestSection.objects.get(slug='1').add_child(slug='11', title='11')
+            TestSection.objects.get(slug='3').delete()
+            self.assertTrue('2/21' in _get_section_path_map())
+            self.assertEqual(get_tree_version(), version)
+            flush_section_changes()
+            paths = _get_section_path_map()
+            self.assertTrue('2/21b' in paths and '2/22b' in paths)
+            self.assertFalse('2/21' in paths)
+            self.assertEqual(
+                paths['4/23/231'], TestSection.objects.get(slug='231').pk
+            )
+            self.assertTrue('1/11' in paths)
+            self.assertFalse('3' in paths)
+            # ...one by one, rather than by rebuilding the map.
+            self.assertEqual(paths.built_at, built_at)
+            self.assertEqual(
+                sorted(paths.keys()),
+                sorted(r[3] for r in TestSection.get_path_records())
+            )
+        finally:
+            app_settings.DEFER_PATH_MAP_UPDATES = defer_updates
+        # ...and changes made in a batch when it exits.
+        with batch_section_changes():
+            with batch_section_changes():
+                TestSection.objects.get(slug='2').add_child(
+                    slug='25', title='25'
+                )
+            self.assertFalse('2/25' in _get_section_path_map())
+            TestSection.objects.get(slug='4').delete()
+        paths = _get_section_path_map()
+        self.assertTrue('2/25' in paths)
+        self.assertFalse('4' in paths)
+        # By default, changes are applied right away, even in a transaction.
+        TestSection.objects.get(slug='2').add_child(slug='26', title='26')
+        self.assertTrue('2/26' in _get_section_path_map())
+
+    def test_middleware_path_map_rebuild_lock(self):
+        """Test that only one process rebuilds the path map at a time."""
+        from django.core.cache import cache
+        from middleware import _build_section_path_map, \
+            _fetch_section_path_map, _get_path_map_lock_key
+        from versions import get_tree_version
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        old_paths = _fetch_section_path_map()
+        lock_wait = app_settings.PATH_CACHE_LOCK_WAIT
+        app_settings.PATH_CACHE_LOCK_WAIT = 0.1
+        app_settings.PATH_CACHE_SOFT_TTL = 60
+        cache.add(_get_path_map_lock_key(), True)
+        try:
+            # While another process holds the lock, a stale map is served...
+            old_paths.built_at -= 120
+            cache.set(app_settings.PATH_CACHE_KEY, old_paths)
+            with self.assertNumQueries(0):
+                paths = _fetch_section_path_map()
+            self.assertEqual(paths.built_at, old_paths.built_at)
+            # ...and a missing one is waited for, then built regardless.
+            cache.delete(app_settings.PATH_CACHE_KEY)
+            self.assertEqual(_fetch_section_path_map().keys(), paths.keys())
+            # Once the lock is released, a stale map is rebuilt, which
+            # doesn't change the tree version.
+            cache.delete(_get_path_map_lock_key())
+            old_paths.built_at -= 120
+            cache.set(app_settings.PATH_CACHE_KEY, old_paths)
+            version = get_tree_version()
+            paths = _fetch_section_path_map()
+            self.assertTrue(paths.built_at > old_paths.built_at)
+            self.assertEqual(get_tree_version(), version)
+            # A map built while the tree changed isn't kept.
+            _build_section_path_map('outdated-version')
+            self.assertEqual(cache.get(app_settings.PATH_CACHE_KEY), None)
+        finally:
+            cache.delete(_get_path_map_lock_key())
+            app_settings.PATH_CACHE_LOCK_WAIT = lock_wait
+            app_settings.PATH_CACHE_SOFT_TTL = None
+
+    def test_middleware_local_path_map(self):
+        """Test the process-local copy of the path map."""
+        from django.core.cache import cache
+        from middleware import _get_section_path_map
+        from versions import bump_tree_version
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        paths = _get_section_path_map()
+        # The local copy is used for as long as the tree version is the same.
+        cache.delete(app_settings.PATH_CACHE_KEY)
+        with self.assertNumQueries(0):
+            self.assertTrue(_get_section_path_map() is paths)
+        # Once it changes, the index is fetched (here, rebuilt) again.
+        bump_tree_version()
+        with self.assertNumQueries(1):
+            new_paths = _get_section_path_map()
+        self.assertFalse(new_paths is paths)
+        self.assertEqual(new_paths.keys(), paths.keys())
+
+    def test_middleware_stale_local_path_map(self):
+        """
+        Test that a stale local copy of the path map isn't fetched again for
+        every request while another process rebuilds it.
+        """
+        from django.core.cache import cache
+        import middleware
+        from versions import get_tree_version
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        version = get_tree_version()
+        stale_paths = middleware._fetch_section_path_map()
+        stale_paths.built_at -= 120
+        cache.set(app_settings.PATH_CACHE_KEY, stale_paths)
+        lock_wait = app_settings.PATH_CACHE_LOCK_WAIT
+        app_settings.PATH_CACHE_LOCK_WAIT = 60
+        app_settings.PATH_CACHE_SOFT_TTL = 60
+        cache.add(middleware._get_path_map_lock_key(), True)
+        try:
+            middleware._local_path_map = (version, stale_paths, 0)
+            paths = middleware._get_section_path_map(version)
+            self.assertEqual(paths.built_at, stale_paths.built_at)
+            # The stale copy keeps being served until the rebuild should be
+            # done...
+            with self.assertNumQueries(0):
+                self.assertTrue(
+                    middleware._get_section_path_map(version) is paths
+                )
+            # ...after which it's fetched (here, rebuilt) again.
+            cache.delete(middleware._get_path_map_lock_key())
+            middleware._local_path_map = (version, paths, 0)
+            new_paths = middleware._get_section_path_map(version)
+            self.assertTrue(new_paths.built_at > paths.built_at)
+            self.assertTrue(
+                middleware._get_section_path_map(version) is new_paths
+            )
+        finally:
+            cache.delete(middleware._get_path_map_lock_key())
+            app_settings.PATH_CACHE_LOCK_WAIT = lock_wait
+            app_settings.PATH_CACHE_SOFT_TTL = None
+
+    def test_middleware_dummy_cache(self):
+        """Test that sections are looked up when the cache keeps nothing."""
+        from django.core.cache import get_cache
+        import middleware
+        import versions
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        dummy_cache = get_cache('django.core.cache.backends.dummy.DummyCache')
+        modules = (middleware, versions)
+        use_tree = app_settings.USE_SECTION_TREE
+        caches = [module.cache for module in modules]
+        for module in modules:
+            module.cache = dummy_cache
+        try:
+            request = RequestFactory().get('/2/23/')
+            self.assertEqual(middleware.lookup_section(request).slug, '23')
+            section = TestSection.objects.get(slug='23')
+            section.slug = 'twenty-three'
+            section.save()
+            request = RequestFactory().get('/2/twenty-three/')
+            self.assertEqual(
+                middleware.lookup_section(request).slug, 'twenty-three'
+            )
+            # Without versions to go by, the tree snapshot is rebuilt every
+            # time it's used.
+            app_settings.USE_SECTION_TREE = True
+            subsection = TestSection.objects.get(slug='231')
+            self.assertEqual(subsection.full_path, '2/twenty-three/231')
+            section.slug = '23'
+            section.save()
+            self.assertEqual(subsection.full_path, '2/23/231')
+        finally:
+            app_settings.USE_SECTION_TREE = use_tree
+            for module, module_cache in zip(modules, caches):
+                module.cache = module_cache
+
+    def test_path_miss_cache(self):
+        """Test the record of paths which don't resolve to a section."""
+        from paths import PathMissCache
+        misses = PathMissCache(2, 60)
+        misses.add('a', 1)
+        misses.add('b', 1)
+        self.assertTrue(misses.contains('a', 1))
+        # 'b' is now the least recently used entry, so it's evicted first.
+        misses.add('c', 1)
+        self.assertFalse(misses.contains('b', 1))
+        self.assertTrue(misses.contains('a', 1))
+        self.assertTrue(misses.contains('c', 1))
+        # A new tree version drops everything.
+        self.assertFalse(misses.contains('a', 2))
+        misses = PathMissCache(2, -1)
+        misses.add('a', 1)
+        self.assertFalse(misses.contains('a', 1))
+
+    def test_middleware_lookup_section_miss(self):
+        """Test that paths which don't resolve are remembered."""
+        from django.core.cache import cache
+        from middleware import lookup_section
+        from versions import bump_tree_version
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        request = RequestFactory().get('/2/foo/')
+        self.assertEqual(lookup_section(request), None)
+        cache.delete(app_settings.PATH_CACHE_KEY)
+        app_settings.LOCAL_PATH_CACHE = False
+        try:
+            with self.assertNumQueries(0):
+                self.assertEqual(lookup_section(request), None)
+            self.assertEqual(cache.get(app_settings.PATH_CACHE_KEY), None)
+            bump_tree_version()
+            with self.assertNumQueries(1):
+                self.assertEqual(lookup_section(request), None)
+        finally:
+            app_settings.LOCAL_PATH_CACHE = True
+
+    def test_middleware_lazy_current_section(self):
+        """Test that the middleware looks up the section when it's needed."""
+        from middleware import SectionsMiddleware, get_current_section
+        from context_processors import current_section
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        factory = RequestFactory()
+        middleware = SectionsMiddleware()
+        request = factory.get('/2/23/')
+        with self.assertNumQueries(0):
+            middleware.process_request(request)
+        context = Context(current_section(request))
+        self.assertEqual(
+            Template("{{current_section.title}}").render(context), '23'
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(get_current_section().slug, '23')
+        # Once the request is handled, its section is forgotten.
+        middleware.process_response(request, None)
+        self.assertEqual(get_current_section(), None)
+        self.assertEqual(get_current_section(request).slug, '23')
+        other_request = factory.get('/4/')
+        self.assertEqual(get_current_section(other_request).slug, '4')
+        app_settings.MIDDLEWARE_EXCLUDE_PREFIXES = ('/2/',)
+        try:
+            middleware.process_request(factory.get('/2/23/'))
+            self.assertEqual(get_current_section(), None)
+            middleware.process_request(factory.get('/4/'))
+            self.assertEqual(get_current_section().slug, '4')
+        finally:
+            app_settings.MIDDLEWARE_EXCLUDE_PREFIXES = ()
+        app_settings.MIDDLEWARE_INCLUDE_PREFIXES = ('/2/',)
+        try:
+            middleware.process_request(factory.get('/4/'))
+            self.assertEqual(get_current_section(), None)
+        finally:
+            app_settings.MIDDLEWARE_INCLUDE_PREFIXES = None
+
+    def test_middleware_lookup_section_records(self):
+        """Test resolving sections from cached section records."""
+        from middleware import lookup_section, _build_section_path_map
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        request = RequestFactory().get('/2/23/')
+        app_settings.CACHE_SECTION_RECORDS = True
+        try:
+            _build_section_path_map()
+            with self.assertNumQueries(0):
+                section = lookup_section(request)
+                self.assertEqual(section.title, '23')
+                self.assertEqual(section.full_path, '2/23')
+                self.assertEqual(section.depth, 2)
+            real_section = TestSection.objects.get(slug='23')
+            self.assertEqual(section, real_section)
+            self.assertEqual(real_section, section)
+            self.assertFalse(real_section != section)
+            self.assertNotEqual(TestSection.objects.get(slug='2'), section)
+            with self.assertNumQueries(1):
+                self.assertEqual(section.description, '23')
+        finally:
+            app_settings.CACHE_SECTION_RECORDS = False
+
     def test_templatetag_get_root_sections(self):
         """Test that the get_root_sections template tag works as expected."""
         TestSection.load_bulk(BASE_DATA)
@@ -474,6 +1550,62 @@ class SectionTest(TestCase):
         for root in TestSection.get_root_nodes():
             self.assertTrue(root.title in result)
         self.assertTrue('<li class="active">2</li>' in result)
+        # The root sections are cached, and the active one is found without
+        # querying, whether from a section or from its cached record.
+        subsection = TestSection.objects.get(slug='41')
+        lazy_section = TestSection.get_section_tree().get_section(
+            TestSection.objects.get(slug='231').pk
+        )
+        with self.assertNumQueries(0):
+            result = template.render(Context({'subsection': subsection}))
+            self.assertTrue('<li class="active">4</li>' in result)
+            self.assertEqual(result.count('class="active"'), 1)
+            result = template.render(Context({'subsection': lazy_section}))
+            self.assertTrue('<li class="active">2</li>' in result)
+        # Changing a section invalidates the cached list.
+        root = TestSection.objects.get(slug='4')
+        root.title = 'Four'
+        root.save()
+        result = template.render(Context({'subsection': subsection}))
+        self.assertTrue('<li class="active">Four</li>' in result)
+
+    def test_templatetag_section_tree(self):
+        """Test rendering navigation with the section_tree template tag."""
+        TestSection.load_bulk(BASE_DATA)
+        self._patch_get_extending_model()
+        template = Template("""{%load sections%}
+        {% section_tree depth 2 with subsection %}
+        """)
+        context = Context({'subsection': TestSection.objects.get(slug='231')})
+        with self.assertNumQueries(1):
+            result = template.render(context)
+        self.assertTrue('<a href="/2/23">23</a>' in result)
+        self.assertTrue('/2/23/231' not in result)
+        self.assertEqual(result.count('class="ancestor"'), 2)
+        self.assertEqual(result.count('class="active"'), 0)
+        # The rendered tree is cached.
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(context), result)
+        template = Template("""{%load sections%}
+        {% section_tree rootsection with subsection %}
+        """)
+        ttl = app_settings.NAVIGATION_CACHE_TTL
+        app_settings.NAVIGATION_CACHE_TTL = 0
+        try:
+            context = Context({
+                'rootsection': TestSection.objects.get(slug='2'),
+                'subsection': TestSection.objects.get(slug='231'),
+            })
+            with self.assertNumQueries(0):
+                result = template.render(context)
+        finally:
+            app_settings.NAVIGATION_CACHE_TTL = ttl
+        self.assertTrue('"/1"' not in result)
+        self.assertTrue(
+            '<li class="active">\n        <a href="/2/23/231">231</a>' in 
+            result
+        )
+        self.assertEqual(result.count('class="ancestor"'), 1)
 
     def test_templatetag_section_is_descendant(self):
         """
@@ -505,4 +1637,56 @@ class SectionTest(TestCase):
         })
         result = template.render(context)
         self.assertTrue('Passes Test 1' not in result)
-        self.assertTrue('Passes Test 2' in result)
\ No newline at end of file
+        self.assertTrue('Passes Test 2' in result)
+
+        # Sections and cached section records are checked without queries.
+        tree = TestSection.get_section_tree()
+        context = Context({
+            'subsection': tree.get_section(
+                TestSection.objects.get(slug='231').pk
+            ),
+            'orphan': TestSection.objects.get(slug='1'),
+            'rootsection': TestSection.objects.get(slug='2'),
+        })
+        with self.assertNumQueries(0):
+            result = template.render(context)
+        self.assertTrue('Passes Test 1' in result)
+        self.assertTrue('Passes Test 2' in result)
+
+    def test_templatetag_section_is_descendant_node_types(self):
+        """
+        Test that section_is_descendant checks nested set sections by their
+        bounds, without queries.
+        """
+        from templatetags.sections import _is_descendant
+        TestNSSection.load_bulk(_get_tree_data(BASE_DATA))
+        sections = dict((s.slug, s) for s in TestNSSection.objects.all())
+        with self.assertNumQueries(0):
+            self.assertTrue(_is_descendant(sections['231'], sections['2']))
+            self.assertTrue(_is_descendant(sections['2'], sections['2']))
+            self.assertFalse(_is_descendant(sections['2'], sections['231']))
+            self.assertFalse(_is_descendant(sections['41'], sections['2']))
+            self.assertFalse(_is_descendant(sections['3'], sections['2']))
+
+    def test_templatetag_mark_section_descendants(self):
+        """
+        Test that the mark_section_descendants template tag works as
+        expected.
+        """
+        TestSection.load_bulk(BASE_DATA)
+        template = Template("""{%load sections%}
+        {% mark_section_descendants sections of rootsection as sections %}
+        {% for section in sections %}{% if section.is_descendant %}
+            {{ section.slug }}{% endif %}{% endfor %}
+        """)
+        context = Context({
+            'sections': list(TestSection.objects.all()),
+            'rootsection': TestSection.objects.get(slug='2'),
+        })
+        with self.assertNumQueries(0):
+            result = template.render(context)
+        self.assertEqual(
+            result.split(), ['2', '21', '22', '23', '231', '24']
+        )
+        context = Context({'sections': None, 'rootsection': None})
+        self.assertEqual(template.render(context).split(), [])
\ No newline at end of file
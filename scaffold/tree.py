@@ -0,0 +1,473 @@
+"""
+An in-memory snapshot of the whole section tree, used to answer navigation
+reads (ancestors, children, descendants, full paths) without touching the
+database.
+"""
+from array import array
+from bisect import bisect_left
+from hashlib import md5
+import mmap
+import os
+import struct
+import tempfile
+
+from django.core.cache import cache
+
+import app_settings
+from paths import LazySection
+from versions import get_tree_version, get_sections_version
+
+# The binary format of a serialized tree: a header, a fixed-size record per
+# section (in tree order), a (pk, index) lookup table sorted by pk, and the
+# UTF-8 encoded slugs and titles. All integers are little-endian.
+_MAGIC = 'SCTR'
+_FORMAT_VERSION = 1
+_HEADER = struct.Struct('<4sBI')
+# pk, parent index, depth, end index, order, slug offset, slug length, title
+# offset, title length
+_RECORD = struct.Struct('<qiiiiIIII')
+_LOOKUP = struct.Struct('<qi')
+
+class _PackedColumn(object):
+    """
+    A read-only sequence over one field of the records of a serialized tree,
+    read straight from the underlying buffer (which may be a memory map).
+    """
+
+    def __init__(self, data, offset, length, field):
+        self.data = data
+        self.offset = offset
+        self.length = length
+        self.field = field
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        return self._read(index)
+
+    def _read(self, index):
+        return _RECORD.unpack_from(
+            self.data, self.offset + index * _RECORD.size
+        )[self.field]
+
+class _PackedStrings(_PackedColumn):
+    """
+    A read-only sequence over the slugs or titles of a serialized tree. The
+    field is that of the string's offset; its length follows it.
+    """
+
+    def __init__(self, data, offset, length, field, strings_offset):
+        super(_PackedStrings, self).__init__(data, offset, length, field)
+        self.strings_offset = strings_offset
+
+    def _read(self, index):
+        record = _RECORD.unpack_from(
+            self.data, self.offset + index * _RECORD.size
+        )
+        start = self.strings_offset + record[self.field]
+        end = start + record[self.field + 1]
+        return self.data[start:end].decode('utf-8')
+
+class _PackedKeys(object):
+    """The sorted pks of a serialized tree's lookup table, for bisect."""
+
+    def __init__(self, data, offset, length):
+        self.data = data
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        return _LOOKUP.unpack_from(
+            self.data, self.offset + position * _LOOKUP.size
+        )[0]
+
+class _PackedIndex(_PackedKeys):
+    """
+    Maps primary keys to indexes in a serialized tree, by binary search in
+    its lookup table.
+    """
+
+    def __getitem__(self, pk):
+        keys = _PackedKeys(self.data, self.offset, self.length)
+        position = bisect_left(keys, pk)
+        if position < self.length:
+            found, index = _LOOKUP.unpack_from(
+                self.data, self.offset + position * _LOOKUP.size
+            )
+            if found == pk:
+                return index
+        raise KeyError(pk)
+
+    def get(self, pk, default=None):
+        try:
+            return self[pk]
+        except KeyError:
+            return default
+
+    def __contains__(self, pk):
+        return self.get(pk) is not None
+
+class _FullPaths(object):
+    """Computes the full paths of the sections of a serialized tree."""
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.tree.pks)
+
+    def __getitem__(self, index):
+        slugs = []
+        while index != -1:
+            slugs.append(self.tree.slugs[index])
+            index = self.tree.parents[index]
+        slugs.reverse()
+        return "/".join(slugs)
+
+class SectionTree(object):
+    """
+    A compact, read-only snapshot of a section tree. Sections are stored in
+    depth-first tree order in parallel arrays (pk, parent index, depth,
+    slug, title, order), so the descendants of a section are the contiguous
+    run of sections following it.
+
+    Sections are identified by primary key in every method; looking up an
+    unknown pk raises a KeyError.
+    """
+
+    def __init__(self, model, rows):
+        """
+        Builds the snapshot from ``(pk, parent pk, depth, slug, title,
+        order)`` rows in tree order, as returned by
+        ``model.get_tree_rows('slug', 'title', 'order')``.
+        """
+        self.model = model
+        self.pks = []
+        self.parents = array('l')
+        self.depths = array('l')
+        self.slugs = []
+        self.titles = []
+        self.orders = array('l')
+        # The index following the last descendant of each section.
+        self.ends = array('l')
+        self.full_paths = []
+        self._indexes = {}
+        # Sections whose subtree is still open, as (index, depth) tuples.
+        open_sections = []
+        for index, (pk, parent, depth, slug, title, order) in \
+            enumerate(rows):
+            while open_sections and open_sections[-1][1] >= depth:
+                self.ends[open_sections.pop()[0]] = index
+            parent_index = self._indexes.get(parent, -1)
+            self._indexes[pk] = index
+            self.pks.append(pk)
+            self.parents.append(parent_index)
+            self.depths.append(depth)
+            self.slugs.append(slug)
+            self.titles.append(title)
+            self.orders.append(order or 0)
+            self.ends.append(index + 1)
+            if parent_index == -1:
+                self.full_paths.append(slug)
+            else:
+                self.full_paths.append(
+                    self.full_paths[parent_index] + "/" + slug
+                )
+            open_sections.append((index, depth))
+        for index, depth in open_sections:
+            self.ends[index] = len(self.pks)
+
+    @classmethod
+    def build(cls, model):
+        """Builds a snapshot of the tree of the given model, in one query."""
+        return cls(model, model.get_tree_rows('slug', 'title', 'order'))
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __contains__(self, pk):
+        return pk in self._indexes
+
+    def _index(self, pk):
+        return self._indexes[pk]
+
+    def to_bytes(self):
+        """
+        Serializes the tree into a compact binary string, which from_bytes
+        turns back into a tree. Only integer primary keys are supported.
+        """
+        records = []
+        strings = []
+        strings_length = 0
+        for index, pk in enumerate(self.pks):
+            slug = self.slugs[index].encode('utf-8')
+            title = self.titles[index].encode('utf-8')
+            records.append(_RECORD.pack(
+                pk,
+                self.parents[index],
+                self.depths[index],
+                self.ends[index],
+                self.orders[index],
+                strings_length,
+                len(slug),
+                strings_length + len(slug),
+                len(title)
+            ))
+            strings.extend([slug, title])
+            strings_length += len(slug) + len(title)
+        lookup = [
+            _LOOKUP.pack(pk, index)
+            for pk, index in sorted(zip(self.pks, range(len(self.pks))))
+        ]
+        return "".join(
+            [_HEADER.pack(_MAGIC, _FORMAT_VERSION, len(self.pks))] +
+            records + lookup + strings
+        )
+
+    @classmethod
+    def from_bytes(cls, model, data):
+        """
+        Loads a tree serialized by to_bytes from the given string or buffer
+        (e.g. a memory-mapped file). Nothing is copied out of the buffer up
+        front; each lookup reads what it needs from it.
+        """
+        magic, format_version, length = _HEADER.unpack_from(data)
+        if magic != _MAGIC or format_version != _FORMAT_VERSION:
+            raise ValueError("Not a serialized section tree.")
+        records_offset = _HEADER.size
+        lookup_offset = records_offset + length * _RECORD.size
+        strings_offset = lookup_offset + length * _LOOKUP.size
+        tree = cls.__new__(cls)
+        tree.model = model
+        tree.data = data
+        column = lambda field: _PackedColumn(
+            data, records_offset, length, field
+        )
+        tree.pks = column(0)
+        tree.parents = column(1)
+        tree.depths = column(2)
+        tree.ends = column(3)
+        tree.orders = column(4)
+        tree.slugs = _PackedStrings(
+            data, records_offset, length, 5, strings_offset
+        )
+        tree.titles = _PackedStrings(
+            data, records_offset, length, 7, strings_offset
+        )
+        tree.full_paths = _FullPaths(tree)
+        tree._indexes = _PackedIndex(data, lookup_offset, length)
+        return tree
+
+    def get_full_path(self, pk):
+        return self.full_paths[self._index(pk)]
+
+    def get_depth(self, pk):
+        return self.depths[self._index(pk)]
+
+    def get_parent(self, pk):
+        """Returns the pk of the parent of the section, or None."""
+        parent = self.parents[self._index(pk)]
+        if parent == -1:
+            return None
+        return self.pks[parent]
+
+    def get_ancestors(self, pk):
+        """Returns the pks of the section's ancestors, root first."""
+        ancestors = []
+        index = self.parents[self._index(pk)]
+        while index != -1:
+            ancestors.append(self.pks[index])
+            index = self.parents[index]
+        ancestors.reverse()
+        return ancestors
+
+    def get_descendants(self, pk):
+        """Returns the pks of the section's descendants, in tree order."""
+        index = self._index(pk)
+        return self.pks[index + 1:self.ends[index]]
+
+    def get_children(self, pk):
+        """Returns the pks of the section's children, in tree order."""
+        index = self._index(pk)
+        children = []
+        child = index + 1
+        while child < self.ends[index]:
+            children.append(self.pks[child])
+            child = self.ends[child]
+        return children
+
+    def get_roots(self):
+        """Returns the pks of the root sections, in tree order."""
+        roots = []
+        index = 0
+        while index < len(self.pks):
+            roots.append(self.pks[index])
+            index = self.ends[index]
+        return roots
+
+    def is_descendant_of(self, pk, ancestor_pk):
+        """
+        Returns True if the section is a descendant of the other section
+        (not counting the section itself), in constant time.
+        """
+        index = self._index(pk)
+        ancestor = self._index(ancestor_pk)
+        return ancestor < index < self.ends[ancestor]
+
+    def get_navigation(self, root_pk=None, depth=None, active_pk=None):
+        """
+        Returns the children of the given section (or the root sections), 
+        nested down to the given number of levels (or all of them), as a 
+        list of dictionaries::
+
+            {
+                'section': <LazySection>,
+                'children': [...],
+                'is_active': <True for the given active section>,
+                'is_ancestor': <True for the active section's ancestors>,
+            }
+        """
+        if active_pk in self:
+            ancestors = set(self.get_ancestors(active_pk))
+        else:
+            ancestors = set()
+
+        def get_nodes(pks, level):
+            nodes = []
+            for pk in pks:
+                children = []
+                if depth is None or level < depth:
+                    children = get_nodes(self.get_children(pk), level + 1)
+                nodes.append({
+                    'section': self.get_section(pk),
+                    'children': children,
+                    'is_active': pk == active_pk,
+                    'is_ancestor': pk in ancestors,
+                })
+            return nodes
+        if root_pk is None:
+            return get_nodes(self.get_roots(), 1)
+        return get_nodes(self.get_children(root_pk), 1)
+
+    def get_record(self, pk):
+        """
+        Returns the ``(pk, title, slug, full path, depth)`` record of the
+        section, as used by LazySection.
+        """
+        index = self._index(pk)
+        return (
+            pk,
+            self.titles[index],
+            self.slugs[index],
+            self.full_paths[index],
+            self.depths[index]
+        )
+
+    def get_section(self, pk):
+        """
+        Returns a LazySection for the section, which only loads the real
+        section from the database if something beyond its record is used.
+        """
+        return LazySection(self.model, self.get_record(pk))
+
+# Snapshots by section model, as (version, tree) tuples. No version matches
+# the placeholder used for models without a snapshot yet.
+_trees = {}
+_NO_TREE = (object(), None)
+
+def _get_tree_name(model, version):
+    return "%s-tree-%s-%s" % (
+        app_settings.PATH_CACHE_KEY,
+        model._meta.app_label + "." + model._meta.object_name,
+        md5("%s-%s" % version).hexdigest()
+    )
+
+def _load_cached_tree(model, version):
+    """
+    Loads the tree of the given version from the cache, publishing it there
+    first if no other process has.
+    """
+    key = _get_tree_name(model, version)
+    data = cache.get(key)
+    if data is None:
+        data = SectionTree.build(model).to_bytes()
+        cache.set(key, data, app_settings.PATH_CACHE_TTL)
+    return SectionTree.from_bytes(model, data)
+
+def _load_mapped_tree(model, version):
+    """
+    Loads the tree of the given version from a file in the
+    SCAFFOLD_SECTION_TREE_DIR directory, publishing it there first if no
+    other process has. The file is memory-mapped read-only, so all processes
+    on a host share a single copy of it.
+    """
+    directory = app_settings.SECTION_TREE_DIR or tempfile.gettempdir()
+    path = os.path.join(directory, _get_tree_name(model, version) + ".bin")
+    if not os.path.exists(path):
+        data = SectionTree.build(model).to_bytes()
+        # Write to a temporary file first, so that no process ever maps a
+        # partially written one.
+        descriptor, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            os.write(descriptor, data)
+        finally:
+            os.close(descriptor)
+        os.rename(temp_path, path)
+    try:
+        tree_file = open(path, 'rb')
+        try:
+            data = mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            tree_file.close()
+    except (IOError, OSError):
+        # Another process removed the file once it had replaced it with a
+        # newer version, so this one is about to be outdated as well. Build
+        # a private copy rather than publishing it again.
+        return SectionTree.build(model)
+    tree = SectionTree.from_bytes(model, data)
+    tree.path = path
+    return tree
+
+def get_section_tree(model):
+    """
+    Returns the snapshot of the given section model's tree. Each process
+    keeps its own copy, which is replaced once any section has been added,
+    changed, moved or removed by any process.
+
+    By default each process builds the snapshot itself, with a single query.
+    If SCAFFOLD_SECTION_TREE_STORAGE is 'cache' or 'file', one process builds
+    and publishes a serialized snapshot of each version and the others load
+    it without touching the database (see SectionTree.to_bytes).
+    """
+    version = (get_tree_version(), get_sections_version())
+    tree_version, tree = _trees.get(model, _NO_TREE)
+    if tree_version == version:
+        return tree
+    storage = app_settings.SECTION_TREE_STORAGE
+    if storage == 'cache':
+        tree = _load_cached_tree(model, version)
+    elif storage == 'file':
+        old_tree = tree
+        tree = _load_mapped_tree(model, version)
+        old_path = getattr(old_tree, 'path', None)
+        if old_path is not None and old_path != tree.path:
+            # Processes which still map the outdated file keep their copy of
+            # it; only its name goes away.
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    else:
+        tree = SectionTree.build(model)
+    _trees[model] = (version, tree)
+    return tree
@@ -0,0 +1,60 @@
+"""
+Version stamps kept in Django's cache. Anything derived from the section tree
+(the path map, tree snapshots, cached navigation) can be keyed or validated by
+the tree version, which lets every worker process detect a change made by any
+other one.
+"""
+import uuid
+
+from django.core.cache import cache
+
+import app_settings
+
+def _get_version_key(name):
+    return "%s-%s-version" % (app_settings.PATH_CACHE_KEY, name)
+
+def get_version(name):
+    """
+    Returns the current version stamp with the given name, creating one if
+    it does not exist yet (or has fallen out of the cache).
+    """
+    key = _get_version_key(name)
+    version = cache.get(key)
+    if version is None:
+        new_version = uuid.uuid4().hex
+        cache.add(key, new_version, app_settings.PATH_CACHE_TTL)
+        # Another process may have added a version first. If the cache
+        # doesn't keep anything (e.g. the dummy cache), every call returns a
+        # new version, so nothing derived from the tree is ever reused.
+        version = cache.get(key) or new_version
+    return version
+
+def bump_version(name):
+    """
+    Replaces the version stamp with the given name with a new, unique one and
+    returns it.
+    """
+    version = uuid.uuid4().hex
+    cache.set(_get_version_key(name), version, app_settings.PATH_CACHE_TTL)
+    return version
+
+def get_tree_version():
+    """
+    Returns the version stamp of the section tree. It changes whenever a
+    section is added, removed, moved or has its slug changed.
+    """
+    return get_version('tree')
+
+def bump_tree_version():
+    return bump_version('tree')
+
+def get_sections_version():
+    """
+    Returns the version stamp of the sections' data. Unlike the tree version,
+    it changes whenever any section is saved (whatever changed), moved or
+    removed.
+    """
+    return get_version('sections')
+
+def bump_sections_version():
+    return bump_version('sections')